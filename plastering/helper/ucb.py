@@ -77,6 +77,7 @@ def make_bio_word_label(word, label):
 def load_ucb_building(building='soda',
                       filename='./groundtruth/SODA-GROUND-TRUTH',
                       pgid=None,
+                      batch_size=1000,
                       ):
     assert building in ['soda', 'sdh', 'ibm'], \
         'Srong building name: {0}'.format(building)
@@ -87,6 +88,8 @@ def load_ucb_building(building='soda',
     sentence_dict = {}
     tagsets_dict = {}
     tagsets_parsing = {}
+    metadata_dict = {}
+    labels_dict = {}
     for i, sentence in enumerate(rawlines[::2]):
         i *= 2
         srcid = '_'.join(re.findall('[a-zA-Z0-9]+', sentence))
@@ -125,22 +128,13 @@ def load_ucb_building(building='soda',
         tagsets_parsing = reduce(adder, [make_bio_word_label(word, word_tagset)
                                          for word, word_tagset
                                          in zip(words, word_tagsets)])
-        raw_obj = RawMetadata.objects(srcid=srcid)\
-            .upsert_one(srcid=srcid, building=building)
-        raw_obj.metadata['VendorGivenName'] = srcid
-        raw_obj.save()
-
-        labeled_obj = LabeledMetadata.objects(
-            srcid=srcid,
-            pgid=pgid,
-        ).upsert_one(
-            srcid=srcid,
-            building=building,
-            point_tagset=point_tagset,
-            tagsets=tagsets,
-            pgid=pgid,
-        )
-        labeled_obj.save()
+        metadata_dict[srcid] = {'VendorGivenName': srcid}
+        labels_dict[srcid] = {
+            'point_tagset': point_tagset,
+            'tagsets': tagsets,
+        }
+    bulk_insert_rawmetadata(building, metadata_dict, batch_size, merge=True)
+    bulk_insert_groundtruth(building, pgid, labels_dict, batch_size)
     with open('groundtruth/{0}_tagsets.json'.format(building), 'w') as fp:
         json.dump(tagsets_dict, fp, indent=2)
     #with open('rawdata/metadata/{0}_sentence_dict_justseparate'.json
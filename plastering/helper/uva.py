@@ -3,21 +3,20 @@ import pandas as pd
 from ..metadata_interface import *
 
 def load_uva_building(building='uva_cse',
-                      filename='./groundtruth/uva_cse_point_map.csv'):
+                      filename='./groundtruth/uva_cse_point_map.csv',
+                      pgid=None,
+                      batch_size=1000):
     df = pd.read_csv(filename)
+    metadata_dict = {}
+    labels_dict = {}
     for i, row in df.iterrows():
         srcid = row['original label'].replace(' ', '_')
         tagset = '_'.join(row['tagset'].split())
+        metadata_dict[srcid] = {'VendorGivenName': srcid}
+        labels_dict[srcid] = {'point_tagset': tagset}
 
-        # Store raw metadata
-        raw_obj = RawMetadata.objects(srcid=srcid)\
-            .upsert_one(srcid=srcid, building=building)
-        raw_obj.metadata['VendorGivenName'] = srcid
-        raw_obj.save()
-
-        # Store ground truth
-        labeled_obj = LabeledMetadata.objects(srcid=srcid)\
-            .upsert_one(srcid=srcid, building=building)
-        labeled_obj.point_tagset = tagset
-        labeled_obj.save()
+    # Store raw metadata
+    bulk_insert_rawmetadata(building, metadata_dict, batch_size, merge=True)
+    # Store ground truth
+    bulk_insert_groundtruth(building, pgid, labels_dict, batch_size)
 
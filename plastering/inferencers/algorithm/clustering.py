@@ -0,0 +1,38 @@
+import numpy as np
+from scipy import sparse
+
+
+def dedup_rows(bow):
+    """Collapse identical rows of a bag-of-words matrix.
+
+    Returns the unique rows as a dense array and, for every original row,
+    the index of its unique row.
+    """
+    bow = sparse.csr_matrix(bow, copy=True)
+    bow.sum_duplicates()
+    bow.eliminate_zeros()
+    bow.sort_indices()
+    row_ids = {}
+    uniq_rows = []
+    inverse = np.empty(bow.shape[0], dtype=np.intp)
+    for i in range(bow.shape[0]):
+        begin, end = bow.indptr[i], bow.indptr[i + 1]
+        key = (bow.indices[begin:end].tobytes(), bow.data[begin:end].tobytes())
+        if key not in row_ids:
+            row_ids[key] = len(uniq_rows)
+            uniq_rows.append(i)
+        inverse[i] = row_ids[key]
+    return bow[uniq_rows].toarray(), inverse
+
+
+def get_cut_threshold(z, zero_merged=False, rank=1):
+    """Midpoint of the rank-th and (rank+1)-th smallest distinct merge
+    distances of z, counting from 0.
+
+    zero_merged tells that identical rows were collapsed before building z,
+    i.e., the linkage over all the rows would have merges at distance 0.
+    """
+    dists = sorted(set(z[:, 2]))
+    if zero_merged and dists[0] > 0:
+        dists.insert(0, 0.0)
+    return (dists[rank] + dists[rank + 1]) / 2
@@ -222,8 +222,9 @@ class BuildingAdapterInterface(Inferencer):
 
         acc_with_high_conf = 0
         cnt_with_high_conf = 0
-        for srcid, tagset, prob in zip(srcids, tagsets, confidence):
-            self._add_pred_point_result(self.pred_g, srcid, tagset, prob)
+        self.pred_confidences = {}
+        self.add_preds(self.pred_g, self.pred_confidences, srcids, tagsets,
+                       confidence)
 
         #return srcids, tagsets, confidence
         return self.pred_g
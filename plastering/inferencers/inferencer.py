@@ -102,6 +102,8 @@ class Inferencer(object):
                     self.hotstart = False
                 self.pgid = pgid
                 self.config = config
+                # MetadataSnapshot to serve metadata queries from memory if given.
+                self.metadata_snapshot = config.get('metadata_snapshot')
                 self.training_srcids = []  # already known srcids
                 self.pred = {  # predicted results
                     'tagsets': {},
@@ -133,8 +135,18 @@ class Inferencer(object):
                 )
 
             def query_labels(self, **query):
+                # The DB is queried for what the snapshot does not cover.
+                if self.metadata_snapshot and \
+                        self.metadata_snapshot.covers_query(self.pgid, **query):
+                    return self.metadata_snapshot.query_labels(self.pgid, **query)
                 return query_labels(self.pgid, **query)
 
+            def query_rawmetadata(self, **query):
+                if self.metadata_snapshot and \
+                        self.metadata_snapshot.covers_query(raw=True, **query):
+                    return self.metadata_snapshot.query_rawmetadata(**query)
+                return RawMetadata.objects(**query)
+
             def evaluate_dep(self, pred):
                 points_log = self.evaluate_points()
                 log = {
@@ -343,7 +355,7 @@ class Inferencer(object):
 
                 target_building_training_srcids = \
                     [srcid for srcid in self.training_srcids
-                     if RawMetadata.objects(srcid=srcid, building=self.target_building)]
+                     if self.query_rawmetadata(srcid=srcid, building=self.target_building)]
                 total_training_srcids = deepcopy(self.training_srcids)
                 curr_eval = {
                     'metrics': metrics,
@@ -377,4 +389,14 @@ class Inferencer(object):
                 triple = pred_g.add_pred_point_result(srcid, pred_point)
                 pred_confidences[triple] = pred_prob
 
+            def add_preds(self,
+                          pred_g,
+                          pred_confidences,
+                          srcids,
+                          pred_points,
+                          pred_probs,
+                          ):
+                pred_confidences.update(pred_g.add_pred_point_results(
+                    srcids, pred_points, pred_probs))
+
         return Wrapped
@@ -3,10 +3,26 @@ import pdb
 from rdflib import Namespace
 import json
 import os
+import pickle
+import hashlib
+from copy import deepcopy
 from collections import defaultdict
 
 
-schema_g = rdflib.Graph()
+# schema files -> parsed schema graph
+schema_graphs = {}
+# (version, schema files) -> compiled schema
+compiled_schemas = {}
+SCHEMA_CACHE_DIR = 'temp/brick_schema'
+BRICK_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          '../../../brick'))
+# version -> the Brick and BrickFrame files bundled in BRICK_DIR
+BUNDLED_SCHEMA_FILES = {
+    '1.0.2': ('Brick_1_0_2.ttl', 'BrickFrame_1_0_2.ttl'),
+}
+COMPILED_TOPCLASSES = ['bf:TagSet', 'brick:Point']
+# Bumped when the compiled schema changes for the same schema files.
+COMPILED_SCHEMA_FORMAT = 3
 
 # TODO: Migrate everyhting here under rdf_wrapper
 
@@ -25,55 +41,191 @@ def get_prefixes(version):
     }
 
 
-def get_schema_graph(version):
-    if not schema_g:
-        schema_g.parse('/home/jbkoh/repo/Brick_jbkoh/dist/Brick.ttl', format='turtle')
-        schema_g.parse('/home/jbkoh/repo/Brick_jbkoh/dist/BrickFrame.ttl', format='turtle')
-        # TODO: Parameterize this or use an online link.
-    return schema_g
+def get_remote_schema_files(version):
+    """URLs of the online Brick and BrickFrame files of the version."""
+    return ('https://brickschema.org/schema/{0}/Brick.ttl'.format(version),
+            'https://brickschema.org/schema/{0}/BrickFrame.ttl'.format(version))
+
+def get_schema_files(version, schema_files=None):
+    """Brick and BrickFrame files (paths or URLs) of the version.
+
+    The bundled files of the version are used if schema_files is not given.
+    The online files are only used if given, e.g., by get_remote_schema_files.
+    """
+    if schema_files:
+        return tuple(schema_files)
+    if version not in BUNDLED_SCHEMA_FILES:
+        raise Exception('Brick {0} is not bundled. Give its schema files or '
+                        'get_remote_schema_files({0}).'.format(version))
+    return tuple(os.path.join(BRICK_DIR, filename)
+                 for filename in BUNDLED_SCHEMA_FILES[version])
+
+def get_schema_graph(version, schema_files=None):
+    schema_files = get_schema_files(version, schema_files)
+    if schema_files not in schema_graphs:
+        g = rdflib.Graph()
+        for schema_file in schema_files:
+            g.parse(schema_file, format='turtle')
+        schema_graphs[schema_files] = g
+    return schema_graphs[schema_files]
 
 def extract_tagset(uri):
     return uri.split('#')[-1].lower()
 
-def get_subclasses(version, topclass):
+def _resolve_class(g, version, topclass):
+    """topclass, or its lowercase name if the schema names classes so,
+    e.g., brick:point in the bundled files instead of brick:Point."""
+    prefix, name = topclass.split(':')
+    ns = get_prefixes(version)[prefix]
+    if (ns[name], None, None) not in g and (ns[name.lower()], None, None) in g:
+        return '{0}:{1}'.format(prefix, name.lower())
+    return topclass
+
+def _query_subclasses(version, topclass, schema_files=None):
+    g = get_schema_graph(version, schema_files)
     qstr = """
     SELECT ?point where {{
     ?point rdfs:subClassOf+ {0}.
     }}
-    """.format(topclass)
-    g = get_schema_graph(version)
+    """.format(_resolve_class(g, version, topclass))
     return [extract_tagset(row[0]) for row in g.query(qstr, initNs=get_prefixes(version))]
 
-def get_direct_subclasses_dict(version, topclass='bf:TagSet'):
+def _query_direct_subclasses_dict(version, topclass='bf:TagSet', schema_files=None):
     qstr = """
     SELECT ?child ?parent where {{
     ?child rdfs:subClassOf ?parent.
     }}
     """.format(topclass)
-    g = get_schema_graph(version)
+    g = get_schema_graph(version, schema_files)
     subclasses = defaultdict(set)
     for [child, parent] in g.query(qstr, initNs=get_prefixes(version)):
+        if child == parent:
+            # Some schemas declare a class as its own subclass.
+            continue
         subclasses[extract_tagset(parent)].add(extract_tagset(child))
     for k, v in subclasses.items():
         subclasses[k] = list(v)
     return subclasses
 
-def get_subclasses_dict(version, topclass='bf:TagSet'):
+def _query_subclasses_dict(version, topclass='bf:TagSet', schema_files=None):
     # NOTE: Maybe this should consider equivalentClassOF too.
+    g = get_schema_graph(version, schema_files)
     qstr = """
     SELECT ?child ?parent where {{
     ?child rdfs:subClassOf+ ?parent.
     ?parent rdfs:subClassOf* {0}.
     }}
-    """.format(topclass)
-    g = get_schema_graph(version)
+    """.format(_resolve_class(g, version, topclass))
     subclasses = defaultdict(set)
     for [child, parent] in g.query(qstr, initNs=get_prefixes(version)):
+        if child == parent:
+            # Some schemas declare a class as its own subclass.
+            continue
         subclasses[extract_tagset(parent)].add(extract_tagset(child))
     for k, v in subclasses.items():
         subclasses[k] = list(v)
     return subclasses
 
+def _get_schema_hash(version, schema_files):
+    """Hash of the version and the contents of the local schema files.
+
+    Remote files are identified by their URLs.
+    """
+    h = hashlib.sha1('{0}:{1}'.format(COMPILED_SCHEMA_FORMAT, version)
+                     .encode('utf-8'))
+    for schema_file in schema_files:
+        if os.path.isfile(schema_file):
+            with open(schema_file, 'rb') as fp:
+                h.update(fp.read())
+        else:
+            h.update(schema_file.encode('utf-8'))
+    return h.hexdigest()
+
+def compile_schema(version, schema_files=None):
+    """Run the schema queries used by Scrabble once and keep their results."""
+    return {
+        'subclasses': {topclass: _query_subclasses(version, topclass, schema_files)
+                       for topclass in COMPILED_TOPCLASSES},
+        'subclasses_dict': {
+            topclass: dict(_query_subclasses_dict(version, topclass, schema_files))
+            for topclass in COMPILED_TOPCLASSES},
+        'direct_subclasses_dict': dict(
+            _query_direct_subclasses_dict(version, schema_files=schema_files)),
+        'tagset_tree': _build_tagset_tree(version, schema_files),
+    }
+
+def get_compiled_schema(version, schema_files=None, cache_dir=SCHEMA_CACHE_DIR):
+    """Compiled schema of the version, built once per schema files' hash.
+
+    It is pickled under cache_dir (None disables the file cache) and shared
+    by its users, who should not modify it.
+    """
+    schema_files = get_schema_files(version, schema_files)
+    key = (version, schema_files)
+    if key not in compiled_schemas:
+        filename = None
+        if cache_dir:
+            filename = os.path.join(
+                cache_dir, _get_schema_hash(version, schema_files) + '.pkl')
+        if filename and os.path.isfile(filename):
+            with open(filename, 'rb') as fp:
+                compiled_schemas[key] = pickle.load(fp)
+        else:
+            compiled_schemas[key] = compile_schema(version, schema_files)
+            if filename:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(filename, 'wb') as fp:
+                    pickle.dump(compiled_schemas[key], fp,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+    return compiled_schemas[key]
+
+def _copy_subclasses_dict(subclasses_dict):
+    return defaultdict(set, {k: list(v) for k, v in subclasses_dict.items()})
+
+def get_subclasses(version, topclass, schema_files=None):
+    if topclass in COMPILED_TOPCLASSES:
+        schema = get_compiled_schema(version, schema_files)
+        return list(schema['subclasses'][topclass])
+    return _query_subclasses(version, topclass, schema_files)
+
+def get_direct_subclasses_dict(version, topclass='bf:TagSet', schema_files=None):
+    schema = get_compiled_schema(version, schema_files)
+    return _copy_subclasses_dict(schema['direct_subclasses_dict'])
+
+def get_subclasses_dict(version, topclass='bf:TagSet', schema_files=None):
+    if topclass in COMPILED_TOPCLASSES:
+        schema = get_compiled_schema(version, schema_files)
+        return _copy_subclasses_dict(schema['subclasses_dict'][topclass])
+    return _query_subclasses_dict(version, topclass, schema_files)
+
+_ancestors_dicts = {}
+
+def invert_subclasses_dict(subclasses_dict):
+    """Invert superclass -> subclasses into tagset -> set of its superclasses."""
+    ancestors = defaultdict(set)
+    for superclass, subclasses in subclasses_dict.items():
+        for subclass in subclasses:
+            ancestors[subclass].add(superclass)
+    return dict(ancestors)
+
+def get_ancestors_dict(version, topclass='bf:TagSet', schema_files=None):
+    """tagset -> set of all its superclasses, computed once per version.
+
+    The dict is shared by its users, who should not modify it.
+    """
+    key = (version, topclass, get_schema_files(version, schema_files))
+    if key not in _ancestors_dicts:
+        _ancestors_dicts[key] = invert_subclasses_dict(
+            get_subclasses_dict(version, topclass, schema_files))
+    return _ancestors_dicts[key]
+
+def expand_tagsets(tagsets, ancestors_dict):
+    """Add the superclasses of the tagsets."""
+    expanded = set(tagsets)
+    for tagset in tagsets:
+        expanded.update(ancestors_dict.get(tagset, ()))
+    return list(expanded)
+
 pointPostfixes = ['alarm', 'sensor', 'setpoint', 'command', 'status', 'meter']
 equipPostfixes = ['system', 'dhws', 'tower', 'chiller', 'coil', 'fan',
                        'hws', 'storage', 'battery', 'condenser', 'unit', 'fcu',
@@ -95,10 +247,11 @@ def construct_subclass_tree(head, tagset_type, subclasses_dict):
     subclasses = list()
     tagsets = list()
     branches = list()
-    for row in res:
-        thing = row[0]
-        subclass = thing.split('#')[-1]
+    for subclass in res:
         tagset = subclass.lower()
+        if tagset == upper_tagset:
+            # Some schemas declare a class as its own subclass.
+            continue
         if tagset_type == 'point' and tagset.split('_')[-1]\
            not in pointPostfixes:
             continue
@@ -112,8 +265,11 @@ def construct_subclass_tree(head, tagset_type, subclasses_dict):
     tree = {upper_tagset: branches}
     return tree
 
-def get_tagset_tree(version):
-    subclasses = get_direct_subclasses_dict(version)
+def get_tagset_tree(version, schema_files=None):
+    return deepcopy(get_compiled_schema(version, schema_files)['tagset_tree'])
+
+def _build_tagset_tree(version, schema_files=None):
+    subclasses = _query_direct_subclasses_dict(version, schema_files=schema_files)
     tagsetTree = dict()
     for head in ['Sensor', 'Alarm', 'Status', 'Setpoint', 'Command', 'Meter']:
         tagsetTree.update(construct_subclass_tree('brick:'+head, 'point', subclasses))
@@ -121,6 +277,4 @@ def get_tagset_tree(version):
         tagsetTree.update(construct_subclass_tree('brick:'+head, 'equip', subclasses))
     for head in ['Location']:
         tagsetTree.update(construct_subclass_tree('brick:'+head, 'location', subclasses))
-
-
-
+    return tagsetTree
@@ -1,4 +1,7 @@
 import os
+import random
+import threading
+from multiprocessing import Pool
 from uuid import uuid4
 from operator import itemgetter
 from pathlib import Path
@@ -20,10 +23,65 @@ from . import eval_func
 
 curr_dir = Path(os.path.dirname(os.path.abspath(__file__)))
 
+# When trained models are stored in MongoDB: right after training ('sync'),
+# in a background thread ('async', the default) or only by store_models()
+# ('on_demand'). Unstored models are served from memory, and store_models()
+# waits until all of them are stored.
+MODEL_PERSISTENCE_MODES = ['sync', 'async', 'on_demand']
+
+# Fewer sentences than this are tagged in the process regardless of n_jobs.
+MIN_SHARDED_SENTENCES = 1000
+
 def gen_uuid():
     return str(uuid4())
 
 
+def calc_features(sentence):
+    sentenceFeatures = list()
+    sentence = ['$' if c.isdigit() else c for c in sentence]
+    for i, word in enumerate(sentence):
+        features = {
+            'word.lower=' + word.lower(): 1.0,
+            'word.isdigit': float(word.isdigit())
+        }
+        if i == 0:
+            features['BOS'] = 1.0
+        else:
+            features['-1:word.lower=' + sentence[i - 1].lower()] = 1.0
+
+        if i  == 0:
+            pass
+        elif i  == 1:
+            features['SECOND'] = 1.0
+        else:
+            features['-2:word.lower=' + sentence[i - 2].lower()] = 1.0
+
+        if i<len(sentence)-1:
+            features['+1:word.lower='+sentence[i+1].lower()] = 1.0
+        else:
+            features['EOS'] = 1.0
+        sentenceFeatures.append(features)
+    return sentenceFeatures
+
+
+# Tagger of a sharded tagging worker and the model binary it reads in place.
+_shard_tagger = None
+_shard_model_bin = None
+
+def _init_shard_tagger(model_bin):
+    global _shard_tagger, _shard_model_bin
+    _shard_model_bin = model_bin
+    _shard_tagger = pycrfsuite.Tagger()
+    _shard_tagger.open_inmemory(_shard_model_bin)
+
+def _tag_shard(sentences):
+    results = []
+    for sentence in sentences:
+        predicted = _shard_tagger.tag(calc_features(sentence))
+        results.append((predicted, _shard_tagger.probability(predicted)))
+    return results
+
+
 class Char2Ir(BaseScrabble):
     def __init__(self,
                  target_building,
@@ -46,6 +104,34 @@ class Char2Ir(BaseScrabble):
                  learning_srcids,
                  config)
         self.model_uuid = None
+        # model_uuid -> (open tagger, its model binary) in LRU order.
+        self.taggers = OrderedDict()
+        self.tagger_cache_size = max(config.get('tagger_cache_size', 2), 1)
+        self.model_persistence = config.get('model_persistence', 'async')
+        if self.model_persistence not in MODEL_PERSISTENCE_MODES:
+            raise Exception('Not recognized model persistence: {0}'
+                            .format(self.model_persistence))
+        self.unstored_models = {} # model_uuid -> model not yet in MongoDB
+        self.unstored_models_lock = threading.Lock()
+        self.store_threads = []
+        # Tagging is sharded across n_jobs processes if n_jobs > 1.
+        self.n_jobs = config.get('n_jobs', 1)
+        # (model_uuid, srcid) -> (predicted tags, scores) per metadata type.
+        self.prediction_cache = {}
+        # In incremental training, a round trains a new CRF on the new srcids
+        # and replayed learning srcids for crf_inc_iterations. The replay
+        # first covers every label seen so far, so no label is forgotten,
+        # and is then filled up to crf_replay_num srcids. It is drawn with
+        # a random.Random(crf_replay_seed) to be reproducible. The model only
+        # sees a sample of the learning srcids, so it is less accurate than a
+        # full training on label combinations left out of the replay.
+        # Every crf_full_retrain_interval-th round is a full training.
+        self.crf_incremental = config.get('crf_incremental', False)
+        self.crf_replay_num = config.get('crf_replay_num', 200)
+        self.replay_random = random.Random(config.get('crf_replay_seed', 0))
+        self.crf_inc_iterations = config.get('crf_inc_iterations', 50)
+        self.crf_full_retrain_interval = config.get('crf_full_retrain_interval', 5)
+        self.update_num = 0
 
         if 'crftype' in config:
             self.crftype = config['crftype']
@@ -85,6 +171,12 @@ class Char2Ir(BaseScrabble):
             self.use_brick_flag = False  # Temporarily disable it
         """
         self.use_brick_flag = False
+        # (srcid, metadata_type) -> pycrfsuite.ItemSequence. metadata_type
+        # is None for concatenated sentences. Without a size, every sentence
+        # is featurized once in _init_data. With a size, it is an LRU cache
+        # of that many sequences for buildings too large to keep in memory.
+        self.feature_cache = OrderedDict()
+        self.feature_cache_size = config.get('feature_cache_size')
         self._init_data(learning_srcids)
 
     def order_sentence_dict(self, sentence_dict):
@@ -123,7 +215,8 @@ class Char2Ir(BaseScrabble):
                 self.degrade_mask += [1] * curr_sample_len
             if building not in self.building_cluster_dict:
                 self.building_cluster_dict[building] = get_word_clusters(
-                    self.building_sentence_dict[building])
+                    self.building_sentence_dict[building],
+                    algorithm=self.config.get('word_clustering', 'linkage'))
 
         # Construct Brick examples
         brick_sentence_dict = dict()
@@ -145,6 +238,13 @@ class Char2Ir(BaseScrabble):
             self.label_dict.update(brick_label_dict)
         self.sentence_dict = self.order_sentence_dict(self.sentence_dict)
         self.brick_srcids = list(brick_sentence_dict.keys())
+        if self.feature_cache_size is None:
+            for srcid, sentences in self.sentence_dict.items():
+                if self.concatenate_sentences:
+                    self._get_features(srcid)
+                else:
+                    for metadata_type in sentences:
+                        self._get_features(srcid, metadata_type)
 
     def merge_sentences(self, sentences):
         return '@\t@'.join(['@'.join(sentences[column]) for column in column_names
@@ -154,22 +254,73 @@ class Char2Ir(BaseScrabble):
                            if column in labels]).split('@')
 
 
+    def _get_features(self, srcid, metadata_type=None):
+        key = (srcid, metadata_type)
+        features = self.feature_cache.get(key)
+        if features is not None:
+            if self.feature_cache_size is not None:
+                self.feature_cache.move_to_end(key)
+            return features
+        if metadata_type is None:
+            sentence = self.merge_sentences(self.sentence_dict[srcid])
+        else:
+            sentence = self.sentence_dict[srcid][metadata_type]
+        features = pycrfsuite.ItemSequence(self._calc_features(sentence, None))
+        self.feature_cache[key] = features
+        if self.feature_cache_size is not None:
+            while len(self.feature_cache) > self.feature_cache_size:
+                self.feature_cache.popitem(last=False)
+        return features
+
     def _add_point_to_model(self, srcid, trainer):
         if self.concatenate_sentences:
             sentence = self.merge_sentences(self.sentence_dict[srcid])
             labels = self.merge_labels(self.label_dict[srcid])
             assert len(sentence) == len(labels)
-            trainer.append(pycrfsuite.ItemSequence(
-                self._calc_features(sentence, None)), labels)
+            trainer.append(self._get_features(srcid), labels)
         else:
-            for metadata_type, sentence in self.sentence_dict[srcid].items():
+            for metadata_type in self.sentence_dict[srcid].keys():
                 labels = self.label_dict[srcid][metadata_type]
-                trainer.append(pycrfsuite.ItemSequence(
-                    self._calc_features(sentence, None)), labels)
+                trainer.append(self._get_features(srcid, metadata_type), labels)
+
+    def _get_labels(self, srcid):
+        return {label for labels in self.label_dict[srcid].values()
+                for label in labels}
+
+    def _sample_replay_srcids(self, new_srcids, prev_srcids):
+        """Replayed srcids covering every label of prev_srcids that
+        new_srcids do not have, filled up to crf_replay_num srcids."""
+        candidates = list(prev_srcids)
+        self.replay_random.shuffle(candidates)
+        covered = set()
+        for srcid in new_srcids:
+            covered |= self._get_labels(srcid)
+        replay_srcids = []
+        rest = []
+        for srcid in candidates:
+            labels = self._get_labels(srcid)
+            if labels - covered:
+                replay_srcids.append(srcid)
+                covered |= labels
+            else:
+                rest.append(srcid)
+        fill_num = max(self.crf_replay_num - len(replay_srcids), 0)
+        return replay_srcids + rest[:fill_num]
 
     def update_model(self, srcids):
         assert (len(self.source_buildings) == len(self.source_sample_num_list))
         self.learning_srcids += srcids
+        self.update_num += 1
+        incremental = self.crf_incremental and self.model_uuid is not None \
+            and self.update_num % self.crf_full_retrain_interval != 0
+        if incremental:
+            new_srcids = list(OrderedDict.fromkeys(srcids))
+            prev_srcids = [srcid for srcid in OrderedDict.fromkeys(self.learning_srcids)
+                           if srcid not in new_srcids]
+            train_srcids = new_srcids + self._sample_replay_srcids(
+                new_srcids, prev_srcids)
+        else:
+            train_srcids = self.learning_srcids
 
         if self.crfalgo == 'prev':
             crfalgo = 'ap'
@@ -186,10 +337,12 @@ class Char2Ir(BaseScrabble):
             trainer.set('c2', 0.02)
 
             # algorithm: {'lbfgs', 'l2sgd', 'ap', 'pa', 'arow'}
+        if incremental:
+            trainer.set('max_iterations', self.crf_inc_iterations)
         if self.crfalgo != 'prev':
             trainer.set_params({'feature.possible_states': True,
                                 'feature.possible_transitions': True})
-        for srcid in self.learning_srcids:
+        for srcid in train_srcids:
             self._add_point_to_model(srcid, trainer)
         if self.use_brick_flag:
             for srcid in self.brick_srcids:
@@ -205,6 +358,7 @@ class Char2Ir(BaseScrabble):
         print('training crf took: {0}'.format(t1 - t0))
         with open(crf_model_file, 'rb') as fp:
             model_bin = fp.read()
+        os.remove(crf_model_file)
         model = {
             # 'source_list': sample_dict,
             'gen_time': arrow.get().datetime,
@@ -216,23 +370,73 @@ class Char2Ir(BaseScrabble):
             'uuid': model_uuid,
             'crftype': 'crfsuite'
         }
-        store_model(model)
-        os.remove(crf_model_file)
         self.model_uuid = model_uuid
-
-    @staticmethod
-    def _get_model(model_uuid):
+        self.prediction_cache = {}
+        self._cache_tagger(model_uuid, model_bin)
+        with self.unstored_models_lock:
+            self.unstored_models[model_uuid] = model
+        if self.model_persistence == 'sync':
+            self._store_model(model_uuid)
+        elif self.model_persistence == 'async':
+            self.store_threads = [thread for thread in self.store_threads
+                                  if thread.is_alive()]
+            thread = threading.Thread(target=self._store_model,
+                                      args=(model_uuid,))
+            thread.start()
+            self.store_threads.append(thread)
+
+    def _store_model(self, model_uuid):
+        with self.unstored_models_lock:
+            model = self.unstored_models.get(model_uuid)
+        if model is None:
+            return  # Already stored by another thread.
+        store_model(model)
+        with self.unstored_models_lock:
+            self.unstored_models.pop(model_uuid, None)
+
+    def store_models(self):
+        """Store all the trained models not yet in MongoDB."""
+        for thread in self.store_threads:
+            thread.join()
+        self.store_threads = []
+        with self.unstored_models_lock:
+            model_uuids = list(self.unstored_models.keys())
+        for model_uuid in model_uuids:
+            self._store_model(model_uuid)
+
+    def _get_model(self, model_uuid):
+        with self.unstored_models_lock:
+            model = self.unstored_models.get(model_uuid)
+        if model is not None:
+            return model
         model_query = {
             'uuid': model_uuid
         }
         model = get_model(model_query)
         return model
 
+    def _cache_tagger(self, model_uuid, model_bin):
+        # The tagger reads the binary in place, so the binary is kept with it.
+        model_bin = bytes(model_bin)
+        tagger = pycrfsuite.Tagger()
+        tagger.open_inmemory(model_bin)
+        self.taggers[model_uuid] = (tagger, model_bin)
+        while len(self.taggers) > self.tagger_cache_size:
+            _, (old_tagger, _) = self.taggers.popitem(last=False)
+            old_tagger.close()
+        return tagger
+
+    def _get_tagger(self, model_uuid):
+        if model_uuid in self.taggers:
+            self.taggers.move_to_end(model_uuid)
+            return self.taggers[model_uuid][0]
+        model = self._get_model(model_uuid)
+        return self._cache_tagger(model_uuid, model['model_binary'])
+
     def select_informative_samples(self, sample_num):
         target_sentence_dict = {srcid: self.sentence_dict[srcid]
                                 for srcid in self.target_srcids}
 
-        model = self._get_model(self.model_uuid)
         predicted_dict, score_dict, _ = self._predict_and_proba(self.target_srcids)
         # TODO: Validate if the above is same as before
         #predicted_dict, score_dict = self._predict_func(model,
@@ -276,37 +480,8 @@ class Char2Ir(BaseScrabble):
                         break
         return new_srcids
 
-    def _load_crf_model_files(self, model, filename, crftype):
-        crf_model_file = filename
-        with open(crf_model_file, 'wb') as fp:
-            fp.write(model['model_binary'])
-
     def _calc_features(self, sentence, building=None):
-        sentenceFeatures = list()
-        sentence = ['$' if c.isdigit() else c for c in sentence]
-        for i, word in enumerate(sentence):
-            features = {
-                'word.lower=' + word.lower(): 1.0,
-                'word.isdigit': float(word.isdigit())
-            }
-            if i == 0:
-                features['BOS'] = 1.0
-            else:
-                features['-1:word.lower=' + sentence[i - 1].lower()] = 1.0
-
-            if i  == 0:
-                pass
-            elif i  == 1:
-                features['SECOND'] = 1.0
-            else:
-                features['-2:word.lower=' + sentence[i - 2].lower()] = 1.0
-
-            if i<len(sentence)-1:
-                features['+1:word.lower='+sentence[i+1].lower()] = 1.0
-            else:
-                features['EOS'] = 1.0
-            sentenceFeatures.append(features)
-        return sentenceFeatures
+        return calc_features(sentence)
 
     def divide_list(self, l, sep_indices):
         base_idx = 0
@@ -325,31 +500,70 @@ class Char2Ir(BaseScrabble):
 
 
 
-    def _predict_func(self, model, sentence_dict, crftype):
-        crf_model_file = 'temp/{0}.{1}.model'.format(self.model_uuid, crftype)
-        self._load_crf_model_files(model, crf_model_file, crftype)
+    def _get_model_bin(self, tagger):
+        """Model binary of a cached tagger (None if not cached)."""
+        for cached_tagger, model_bin in self.taggers.values():
+            if cached_tagger is tagger:
+                return model_bin
+        return None
+
+    def _count_sentences(self, sentence_dict):
+        if self.concatenate_sentences:
+            return len(sentence_dict)
+        return sum(len(sentences) for sentences in sentence_dict.values())
+
+    def _predict_sharded(self, model_bin, sentence_dict):
+        """Tag sentences in n_jobs processes, each opening the model once."""
+        keys = []
+        sentences = []
+        for srcid, srcid_sentences in sentence_dict.items():
+            if self.concatenate_sentences:
+                keys.append((srcid, 'VendorGivenName'))
+                sentences.append(self.merge_sentences(srcid_sentences))
+            else:
+                for metadata_type, sentence in srcid_sentences.items():
+                    keys.append((srcid, metadata_type))
+                    sentences.append(sentence)
+        shard_size = int(np.ceil(len(sentences) / self.n_jobs))
+        shards = [sentences[i:i + shard_size]
+                  for i in range(0, len(sentences), shard_size)]
+        with Pool(self.n_jobs, initializer=_init_shard_tagger,
+                  initargs=(model_bin,)) as pool:
+            results = pool.map(_tag_shard, shards)
+
+        predicted_dict = {srcid: {} for srcid in sentence_dict}
+        score_dict = {srcid: {} for srcid in sentence_dict}
+        results = (result for shard_results in results for result in shard_results)
+        for (srcid, metadata_type), (predicted, score) in zip(keys, results):
+            predicted_dict[srcid][metadata_type] = predicted
+            score_dict[srcid][metadata_type] = score
+        return predicted_dict, score_dict
 
+    def _predict_func(self, tagger, sentence_dict, crftype):
         predicted_dict = dict()
         score_dict = dict()
         begin_time = arrow.get()
-        if crftype == 'crfsuite':
-            # Init tagger
-            tagger = pycrfsuite.Tagger()
-            tagger.open(crf_model_file)
-
+        # The workers open the model binary of the tagger, which is only
+        # known for the cached taggers.
+        model_bin = self._get_model_bin(tagger) \
+            if crftype == 'crfsuite' and self.n_jobs > 1 else None
+        if model_bin is not None and \
+                self._count_sentences(sentence_dict) >= MIN_SHARDED_SENTENCES:
+            return self._predict_sharded(model_bin, sentence_dict)
+        elif crftype == 'crfsuite':
             # Tagging sentences with tagger
             for srcid, sentences in sentence_dict.items():
                 predicteds = {}
                 scores = {}
                 if self.concatenate_sentences:
-                    sentence = self.merge_sentences(sentences)
-                    predicted = tagger.tag(self._calc_features(sentence))
+                    predicted = tagger.tag(self._get_features(srcid))
                     score = tagger.probability(predicted)
                     predicteds['VendorGivenName'] = predicted
                     scores['VendorGivenName'] = score
                 else:
-                    for metadata_type, sentence in sentences.items():
-                        predicted = tagger.tag(self._calc_features(sentence))
+                    for metadata_type in sentences.keys():
+                        predicted = tagger.tag(
+                            self._get_features(srcid, metadata_type))
                         score = tagger.probability(predicted)
                         predicteds[metadata_type] = predicted
                         scores[metadata_type] = score
@@ -367,10 +581,23 @@ class Char2Ir(BaseScrabble):
 
         target_sentence_dict = {srcid: self.sentence_dict[srcid]
                                 for srcid in target_srcids}
-        model = self._get_model(self.model_uuid)
-        predicted_dict, score_dict = self._predict_func(model,
-                                                        target_sentence_dict,
-                                                        self.crftype)
+        # Only the srcids not tagged yet by the current model are tagged.
+        new_sentence_dict = {srcid: sentences
+                             for srcid, sentences in target_sentence_dict.items()
+                             if (self.model_uuid, srcid) not in self.prediction_cache}
+        if new_sentence_dict:
+            tagger = self._get_tagger(self.model_uuid)
+            new_predicted_dict, new_score_dict = self._predict_func(
+                tagger, new_sentence_dict, self.crftype)
+            for srcid, predicteds in new_predicted_dict.items():
+                self.prediction_cache[(self.model_uuid, srcid)] = \
+                    (predicteds, new_score_dict[srcid])
+        predicted_dict = dict()
+        score_dict = dict()
+        for srcid in target_sentence_dict:
+            predicteds, scores = self.prediction_cache[(self.model_uuid, srcid)]
+            predicted_dict[srcid] = predicteds
+            score_dict[srcid] = dict(scores)
         # Construct output data
         pred_phrase_dict = make_phrase_dict(target_sentence_dict, predicted_dict)
         return predicted_dict, score_dict, pred_phrase_dict
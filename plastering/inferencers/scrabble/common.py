@@ -1,6 +1,7 @@
 import json
 import os
 import argparse
+import hashlib
 import random
 from functools import reduce, partial
 import logging
@@ -9,6 +10,7 @@ from collections import defaultdict, OrderedDict
 import pdb
 import sys
 import requests
+import numpy as np
 import pandas as pd
 
 from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
@@ -16,6 +18,7 @@ from scipy.cluster.hierarchy import linkage
 import scipy.cluster.hierarchy as hier
 
 from .eval_func import *
+from ..algorithm.clustering import dedup_rows, get_cut_threshold
 
 POINT_POSTFIXES = ['sensor', 'setpoint', 'command', 'alarm', 'status', 'meter']
 
@@ -53,7 +56,20 @@ def check_in(x,y):
 def joiner(s):
     return ''.join(s)
 
-def get_word_clusters(sentence_dict):
+# Word clusters are cached by the content hash of their sentence dict and
+# clustering settings in memory and as JSON files under this directory
+# (None disables it).
+WORD_CLUSTER_CACHE_DIR = 'temp/word_clusters'
+# 'linkage' clusters every point. 'dedup' clusters the unique sentences only,
+# which is faster but may break ties among equal distances differently and
+# give different clusters.
+WORD_CLUSTER_ALGORITHMS = ['linkage', 'dedup']
+# The clusters are cut between the 3rd and 4th smallest merge distances.
+WORD_CLUSTER_THRESHOLD_RANK = 2
+_word_cluster_cache = {}
+
+def _calc_word_clusters(sentence_dict, algorithm='linkage',
+                        threshold_rank=WORD_CLUSTER_THRESHOLD_RANK):
     srcids = list(sentence_dict.keys())
     sentences = []
     for srcid in srcids:
@@ -65,22 +81,55 @@ def get_word_clusters(sentence_dict):
         sentences.append(sentence)
     vect = TfidfVectorizer()
     #vect = CountVectorizer()
-    bow = vect.fit_transform(sentences).toarray()
-    try:
-        z = linkage(bow, metric='cityblock', method='complete')
-    except:
-        pdb.set_trace()
-    dists = list(set(z[:,2]))
-    thresh = (dists[2] + dists[3]) /2
-    #thresh = (dists[1] + dists[2]) /2
-    print("Threshold: ", thresh)
-    b = hier.fcluster(z,thresh, criterion='distance')
+    bow = vect.fit_transform(sentences)
+    if algorithm == 'linkage':
+        z = linkage(bow.toarray(), metric='cityblock', method='complete')
+        thresh = get_cut_threshold(z, rank=threshold_rank)
+        print("Threshold: ", thresh)
+        b = hier.fcluster(z,thresh, criterion='distance')
+    elif algorithm == 'dedup':
+        # Points with the same words are at distance 0 and always end up in
+        # the same cluster, so only the unique rows are clustered.
+        uniq_bow, inverse = dedup_rows(bow)
+        z = linkage(uniq_bow, metric='cityblock', method='complete')
+        thresh = get_cut_threshold(z, zero_merged=len(uniq_bow) < len(inverse),
+                                   rank=threshold_rank)
+        print("Threshold: ", thresh)
+        b = hier.fcluster(z,thresh, criterion='distance')[inverse]
+    else:
+        raise Exception('Word clustering algorithm not defined for: {0}'
+                        .format(algorithm))
     cluster_dict = defaultdict(list)
 
     for srcid, cluster_id in zip(srcids, b):
-        cluster_dict[cluster_id].append(srcid)
+        cluster_dict[int(cluster_id)].append(srcid)
     return dict(cluster_dict)
 
+def get_word_clusters(sentence_dict, cache_dir=WORD_CLUSTER_CACHE_DIR,
+                      algorithm='linkage'):
+    # The srcid order is a part of the key as ties are broken by it.
+    key_str = json.dumps({'sentence_dict': sentence_dict,
+                          'srcids': list(sentence_dict.keys()),
+                          'algorithm': algorithm,
+                          'threshold_rank': WORD_CLUSTER_THRESHOLD_RANK},
+                         sort_keys=True)
+    key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+    if key not in _word_cluster_cache:
+        filename = os.path.join(cache_dir, key + '.json') if cache_dir else None
+        if filename and os.path.isfile(filename):
+            with open(filename, 'r') as fp:
+                cluster_dict = {int(cid): cluster
+                                for cid, cluster in json.load(fp).items()}
+        else:
+            cluster_dict = _calc_word_clusters(sentence_dict, algorithm)
+            if filename:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(filename, 'w') as fp:
+                    json.dump(cluster_dict, fp)
+        _word_cluster_cache[key] = cluster_dict
+    return {cid: list(cluster)
+            for cid, cluster in _word_cluster_cache[key].items()}
+
 def select_random_samples(building,
                           srcids,
                           n,
@@ -6,6 +6,7 @@ from scipy.sparse import vstack, csr_matrix, hstack, issparse, coo_matrix,\
                          lil_matrix
 
 from .common import *
+from .brick_parser2 import invert_subclasses_dict
 
 class SingleProjectClassifier():
 
@@ -41,20 +42,24 @@ class SingleProjectClassifier():
 class StructuredClassifierChain():
 
     def __init__(self, base_classifier, binarizer, subclass_dict,
-                 vocabulary_dict, n_jobs=1, use_brick_flag=False, vectorizer=None):
+                 vocabulary_dict, n_jobs=1, use_brick_flag=False, vectorizer=None,
+                 ancestors_dict=None):
         self.vectorizer = vectorizer
         self.prob_flag = False
         self.use_brick_flag = use_brick_flag
         self.n_jobs = n_jobs
         self.vocabulary_dict = vocabulary_dict
         self.subclass_dict = subclass_dict
+        if ancestors_dict is None:
+            ancestors_dict = invert_subclasses_dict(subclass_dict)
+        self.ancestors_dict = ancestors_dict
         self.base_classifier = base_classifier
         self.binarizer = binarizer
         self.upper_y_index_list = list()
         self.lower_y_index_list = list()
         self.base_classifiers = list()
         for i, tagset in enumerate(self.binarizer.classes_):
-            found_upper_tagsets = find_keys(tagset, self.subclass_dict, check_in)
+            found_upper_tagsets = self.ancestors_dict.get(tagset, set())
             upper_tagsets = [ts for ts in self.binarizer.classes_ \
                              if ts in found_upper_tagsets]
             try:
@@ -322,7 +327,7 @@ class StructuredClassifierChain():
         for i, vect in enumerate(Y):
             tagsets = self.binarizer.inverse_transform(vect)[0]
             updated_tagsets = reduce(adder, [
-                                find_keys(tagset, self.subclass_dict, check_in)
+                                list(self.ancestors_dict.get(tagset, ()))
                                 for tagset in tagsets], [])
             #TODO: This is bad code. need to be fixed later.
             finished = False
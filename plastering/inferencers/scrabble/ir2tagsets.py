@@ -28,7 +28,8 @@ from .time_series_to_ir import TimeSeriesToIR
 from .base_scrabble import BaseScrabble
 from .common import *
 from .hcc import StructuredClassifierChain
-from .brick_parser2 import get_subclasses, get_subclasses_dict, get_tagset_tree
+from .brick_parser2 import get_subclasses, get_subclasses_dict, get_tagset_tree, \
+    get_ancestors_dict, expand_tagsets, get_remote_schema_files
 #from .brick_parser import tagsetTree as tagset_tree
 from .dann import DANN
 
@@ -183,24 +184,41 @@ class Ir2Tagsets(BaseScrabble):
             self.expand_tagsets_by_hierarchy_flag = True
 
         self.epochs = config.get('ir2tagsets.epochs', 400)
+        # The bundled Brick files are used unless schema files are given or
+        # brick_schema_remote is set to fetch the online ones.
+        self.brick_version = config.get('brick_version', '1.0.2')
+        if 'brick_file' in config and 'brickframe_file' in config:
+            self.brick_schema_files = [config['brick_file'],
+                                       config['brickframe_file']]
+        elif config.get('brick_schema_remote', False):
+            self.brick_schema_files = get_remote_schema_files(self.brick_version)
+        else:
+            self.brick_schema_files = None
         self.nb_empty_docs = 50
+        self.model_uuid = None
+        # (model_uuid, srcid) -> (predicted tagsets, certainty, probabilities)
+        self.prediction_cache = {}
 
         self._init_brick()
         self._init_data(learning_srcids)
 
     def _init_brick(self):
         self.brick_srcids = []
-        version = '1.0.3' #TODO: Parameterize it from the module
-        self.tagset_list = get_subclasses(version, 'bf:TagSet')
-        self.point_tagsets = get_subclasses(version, 'brick:Point')
+        version = self.brick_version
+        schema_files = self.brick_schema_files
+        self.tagset_list = get_subclasses(version, 'bf:TagSet', schema_files)
+        self.point_tagsets = get_subclasses(version, 'brick:Point', schema_files)
         self.tagset_list.append('networkadapter')
 
-        self.subclass_dict = get_subclasses_dict(version, 'bf:TagSet')
+        self.subclass_dict = get_subclasses_dict(version, 'bf:TagSet',
+                                                 schema_files)
         self.subclass_dict['networkadapter'] = list()
         self.subclass_dict['unknown'] = list()
         self.subclass_dict['none'] = list()
+        self.ancestors_dict = get_ancestors_dict(version, 'bf:TagSet',
+                                                 schema_files)
         #self.tagset_tree = deepcopy(tagset_tree)
-        self.tagset_tree = get_tagset_tree(version)
+        self.tagset_tree = get_tagset_tree(version, schema_files)
 
     def get_srcid_domain(self, srcid):
         # try get building name
@@ -221,12 +239,7 @@ class Ir2Tagsets(BaseScrabble):
 
     def expand_tagsets_by_hierarchy(self):
         for srcid, tagsets in self.tagsets_dict.items():
-            expanded = set(tagsets)
-            for tagset in tagsets:
-                for superclass, subclasses in self.subclass_dict.items():
-                    if tagset in subclasses:
-                        expanded.add(superclass)
-            self.tagsets_dict[srcid] = list(expanded)
+            self.tagsets_dict[srcid] = expand_tagsets(tagsets, self.ancestors_dict)
 
 
     def _init_data(self, learning_srcids=[]):
@@ -266,7 +279,8 @@ class Ir2Tagsets(BaseScrabble):
                 self.point_dict[srcid] = point_tagset
             if building not in self.building_cluster_dict:
                 self.building_cluster_dict[building] = get_word_clusters(
-                    self.building_sentence_dict[building])
+                    self.building_sentence_dict[building],
+                    algorithm=self.config.get('word_clustering', 'linkage'))
 
         self.phrase_dict = make_phrase_dict(self.sentence_dict, 
                                             self.label_dict)
@@ -293,6 +307,9 @@ class Ir2Tagsets(BaseScrabble):
         self._build_tagset_classifier(self.learning_srcids,
                                       self.target_srcids,
                                       validation_srcids=[])
+        self.ancestor_mat = self._get_ancestor_mat(self.tagset_binarizer.classes_)
+        self.model_uuid = gen_uuid()
+        self.prediction_cache = {}
 
     def _determine_used_phrases(self, phrases, tagsets):
         phrases_usages = list()
@@ -437,10 +454,47 @@ class Ir2Tagsets(BaseScrabble):
             phrase_dict[srcid] += list(pred_tags)
         return phrase_dict
 
+    def _get_ancestor_mat(self, tagsets):
+        """ancestor_mat[i, j] is True iff tagsets[i] is a superclass of tagsets[j]."""
+        tagset_idx = {tagset: i for i, tagset in enumerate(tagsets)}
+        rows = []
+        cols = []
+        for j, tagset in enumerate(tagsets):
+            for ancestor in self.ancestors_dict.get(tagset, ()):
+                # A tagset is not its own superclass even if the schema says so.
+                if ancestor in tagset_idx and ancestor != tagset:
+                    rows.append(tagset_idx[ancestor])
+                    cols.append(j)
+        return csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                          shape=(len(tagsets), len(tagsets)))
+
     def _predict_and_proba(self, target_srcids, full_prob=False):
         if not target_srcids:
             return {}, {}
 
+        # Only the srcids not predicted yet by the current model or whose
+        # phrases have changed since are predicted.
+        new_srcids = [srcid for srcid in target_srcids
+                      if (self.model_uuid, srcid) not in self.prediction_cache]
+        if new_srcids:
+            self._predict_new(new_srcids)
+        pred_tagsets_dict = dict()
+        pred_certainty_dict = dict()
+        probs = []
+        for srcid in target_srcids:
+            pred_tagsets, max_prob, prob = \
+                self.prediction_cache[(self.model_uuid, srcid)]
+            pred_tagsets_dict[srcid] = pred_tagsets
+            pred_certainty_dict[srcid] = max_prob
+            probs.append(prob)
+        pred_certainty_dict = OrderedDict(sorted(pred_certainty_dict.items(), \
+                                                 key=itemgetter(1), reverse=True))
+        if full_prob:
+            return pred_tagsets_dict, pred_certainty_dict, np.vstack(probs)
+        else:
+            return pred_tagsets_dict, pred_certainty_dict
+
+    def _predict_new(self, target_srcids):
         phrase_dict = {srcid: self.phrase_dict[srcid]
                        for srcid in target_srcids}
         if self.ts_flag:
@@ -467,36 +521,22 @@ class Ir2Tagsets(BaseScrabble):
                 pred_mat = pred_mat.toarray()
             except:
                 pred_mat = np.asarray(pred_mat)
-        pred_tagsets_dict = dict()
-        pred_certainty_dict = dict()
-        pred_point_dict = dict()
-        for i, (srcid, pred, prob) in enumerate(zip(target_srcids,
-                                              pred_mat,
-                                              prob_mat)):
-            pred_tagsets = self.tagset_binarizer.inverse_transform(np.asarray([pred]))[0]
-            #pred_tagsets_dict[srcid] = self.tagset_binarizer.inverse_transform(\
-            #                                np.asarray([pred]))[0]
-            if self.expand_tagsets_by_hierarchy_flag:
-                filtered = deepcopy(list(pred_tagsets))
-                for curr_tagset in pred_tagsets:
-                    for other_tagset in filtered:
-                        if other_tagset in self.subclass_dict[curr_tagset]:
-                            filtered.remove(curr_tagset)
-                            break
-                pred_tagsets = tuple(filtered)
-                max_prob = max(prob) #TODO: implement this for filtered ones
-            else:
-                max_prob = max(prob)
-            pred_tagsets_dict[srcid] = pred_tagsets
-            pred_certainty_dict[srcid] = max_prob
-            #pred_certainty_dict[srcid] = 0
-        pred_certainty_dict = OrderedDict(sorted(pred_certainty_dict.items(), \
-                                                 key=itemgetter(1), reverse=True))
+        pred_mat = csr_matrix(pred_mat, dtype=np.int32)
+        if self.expand_tagsets_by_hierarchy_flag:
+            # Keep only the most specific tagsets, i.e., drop the ones with
+            # a predicted subclass. ancestors_dict is transitive.
+            has_subclass = pred_mat @ self.ancestor_mat.T.astype(np.int32) > 0
+            pred_mat = pred_mat - pred_mat.multiply(has_subclass)
+            pred_mat.eliminate_zeros()
+        pred_tagsets_list = self.tagset_binarizer.inverse_transform(pred_mat)
+        max_probs = np.max(prob_mat, axis=1) #TODO: implement this for filtered ones
+        for srcid, pred_tagsets, max_prob, prob in zip(target_srcids,
+                                                       pred_tagsets_list,
+                                                       max_probs,
+                                                       prob_mat):
+            self.prediction_cache[(self.model_uuid, srcid)] = \
+                (pred_tagsets, max_prob, prob)
         logging.info('Finished prediction')
-        if full_prob:
-            return pred_tagsets_dict, pred_certainty_dict, prob_mat
-        else:
-            return pred_tagsets_dict, pred_certainty_dict
 
     def predict(self, target_srcids=None):
         if not target_srcids:
@@ -947,7 +987,8 @@ class Ir2Tagsets(BaseScrabble):
                                     self.tagset_vectorizer.vocabulary,
                                     self.n_jobs,
                                     self.use_brick_flag,
-                                    self.tagset_vectorizer)
+                                    self.tagset_vectorizer,
+                                    self.ancestors_dict)
                 return tagset_classifier
             meta_classifier = meta_scc
             rf_params_list_dict = {
@@ -992,7 +1033,8 @@ class Ir2Tagsets(BaseScrabble):
                                     self.tagset_vectorizer.vocabulary,
                                     self.n_jobs,
                                     self.use_brick_flag,
-                                    self.tagset_vectorizer)
+                                    self.tagset_vectorizer,
+                                    self.ancestors_dict)
                 return tagset_classifier
             meta_classifier = meta_scc
             rf_params_list_dict = {
@@ -1243,5 +1285,8 @@ class Ir2Tagsets(BaseScrabble):
         return meta_classifier(**best_params)
 
     def update_phrases(self, phrases):
+        for srcid, srcid_phrases in phrases.items():
+            if self.phrase_dict.get(srcid) != srcid_phrases:
+                self.prediction_cache.pop((self.model_uuid, srcid), None)
         self.phrase_dict.update(phrases)
 
@@ -29,7 +29,9 @@ def load_data(target_building,
               #bacnettype_mapping_file='config/bacnettype_mapping.csv',
               bacnettype_flag=False,
               metadata_types=['VendorGivenName'],
+              snapshot=None,
               ):
+    # snapshot: MetadataSnapshot to read the metadata from instead of the DB.
     building_sentence_dict = dict()
     building_label_dict = dict()
     building_tagsets_dict = dict()
@@ -50,7 +52,13 @@ def load_data(target_building,
     for building in source_buildings:
         true_tagsets = {}
         label_dict = {}
-        for labeled in LabeledMetadata.objects(building=building):
+        if snapshot and snapshot.covers(building):
+            labeled_docs = snapshot.query_labels(building=building)
+            raw_docs = snapshot.query_rawmetadata(building=building)
+        else:
+            labeled_docs = LabeledMetadata.objects(building=building)
+            raw_docs = RawMetadata.objects(building=building)
+        for labeled in labeled_docs:
             srcid = labeled.srcid
             true_tagsets[srcid] = labeled.tagsets
             fullparsing = labeled.fullparsing
@@ -62,7 +70,7 @@ def load_data(target_building,
         building_tagsets_dict[building] = true_tagsets
         building_label_dict[building] = label_dict
         sentence_dict = dict()
-        for raw_point in RawMetadata.objects(building=building):
+        for raw_point in raw_docs:
             srcid = raw_point.srcid
             metadata = raw_point['metadata']
             sentences = {}
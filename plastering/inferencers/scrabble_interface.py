@@ -73,6 +73,7 @@ class ScrabbleInterface(object):
             building_tagsets_dict, known_tags_dict = load_data(target_building,
                                                                self.source_buildings,
                                                                metadata_types=self.valid_metadata_types,
+                                                               snapshot=self.metadata_snapshot,
                                                                #metadata_types=['VendorGivenName',
                                                                #                'BACnetName',
                                                                #                'BACnetDescription',
@@ -113,9 +114,10 @@ class ScrabbleInterface(object):
     def postprocessing_pred(self, pred):
         # Currently only ingest point tagsets.
         pred_g = self.new_graph(empty=True)
-        for srcid, tagsets in pred.items():
-            point_tagset = select_point_tagset(tagsets, srcid)
-            pred_g.add_pred_point_result(srcid, point_tagset)
+        srcids = list(pred.keys())
+        point_tagsets = [select_point_tagset(pred[srcid], srcid)
+                         for srcid in srcids]
+        pred_g.add_pred_point_results(srcids, point_tagsets)
         return pred_g
 
     def predict(self, target_srcids=None, output_format='ttl'):
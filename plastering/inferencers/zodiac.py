@@ -12,6 +12,7 @@ from collections import defaultdict
 import arrow
 
 import scipy
+from scipy import sparse
 from scipy.cluster.vq import *
 from scipy.cluster.hierarchy import linkage, dendrogram
 import scipy.cluster.hierarchy as hier
@@ -29,10 +30,12 @@ from sklearn.naive_bayes import MultinomialNB
 
 from . import Inferencer
 from ..metadata_interface import RawMetadata, LabeledMetadata
+from ..metadata_interface import bulk_query_rawmetadata, bulk_query_labels
 from ..common import POINT_TAGSET, adder
 from ..rdf_wrapper.common import parse_srcid
 from ..exceptions import AlgorithmError
 from ..helpers import bidict
+from .algorithm.clustering import dedup_rows, get_cut_threshold
 
 DEBUG = False
 if DEBUG:
@@ -73,6 +76,45 @@ def is_nonempty_item_included(l):
     else:
         return False
 
+
+def linkage_clustering(bow):
+    if sparse.issparse(bow):
+        # linkage only works on dense observations.
+        bow = bow.toarray()
+    z = linkage(bow, metric='cityblock', method='complete')
+    thresh = get_cut_threshold(z)
+    return hier.fcluster(z, thresh, criterion='distance'), thresh
+
+
+def dedup_linkage_clustering(bow):
+    # Identical rows are at distance 0 and always end up in the same cluster,
+    # so only the unique rows need to be clustered. Complete linkage over them
+    # gives the same dendrogram as over all the rows above distance 0 up to
+    # ties: merges at equal (integer) distances may be taken in another
+    # order, so clusters can differ from linkage_clustering's.
+    uniq_bow, inverse = dedup_rows(bow)
+    if uniq_bow.shape[0] < 2:
+        return np.ones(len(inverse), dtype=np.int32), 0.0
+    z = linkage(uniq_bow, metric='cityblock', method='complete')
+    thresh = get_cut_threshold(z, zero_merged=len(uniq_bow) < len(inverse))
+    return hier.fcluster(z, thresh, criterion='distance')[inverse], thresh
+
+
+CLUSTERING_BACKENDS = {
+    'linkage': linkage_clustering,
+    'dedup': dedup_linkage_clustering,
+}
+
+
+def get_clustering_backend(backend):
+    if callable(backend):
+        return backend
+    elif backend in CLUSTERING_BACKENDS:
+        return CLUSTERING_BACKENDS[backend]
+    else:
+        raise Exception('Clustering backend not defined for: {0}'
+                        .format(backend))
+
 # class ZodiacInterface(Inferencer):
 @Inferencer()
 class ZodiacInterface(object):
@@ -104,7 +146,10 @@ class ZodiacInterface(object):
             source_buildings_srcids += source_srcids
 
         # Pick srcids
-        self.total_srcids = deepcopy(target_srcids) + source_buildings_srcids
+        self.total_srcids = []
+        self.srcid_idx = {}  # srcid -> row index of total_bow
+        self.add_srcids(target_srcids)
+        self.add_srcids(source_buildings_srcids)
         self.available_srcids = deepcopy(self.training_srcids)
 
         self.init_model()
@@ -114,7 +159,7 @@ class ZodiacInterface(object):
         # Init buffers
         self.true_labels = {}
         self.training_labels = []
-        self.trained_cids = []
+        self.trained_cids = set()
 
         # Init thresholds
         self.thresholds = [(0.1, 0.95), (0.1, 0.9), (0.15, 0.9), (0.15, 0.85),
@@ -125,27 +170,74 @@ class ZodiacInterface(object):
         self.th_ptr = 0
         self.th_min, self.th_max = self.thresholds[self.th_ptr]
 
+        self.clustering = get_clustering_backend(
+            self.config.get('clustering_backend', 'linkage'))
+
         # Init ML model.
+        self.n_estimators = self.config.get('n_estimators', 400)
         self.model = RandomForestClassifier(
-            n_estimators=self.config.get('n_estimators', 400),
+            n_estimators=self.n_estimators,
             random_state=self.config.get('random_state', 0),
             n_jobs=self.config.get('n_jobs', 6),
         )
+        # With incremental training, new examples are learned by growing
+        # extra trees on the existing forest (warm_start) until the forest
+        # reaches max_estimators, when it is retrained from scratch.
+        self.incremental_training = self.config.get('incremental_training', False)
+        self.n_estimators_inc = self.config.get('n_estimators_inc', 50)
+        self.max_estimators = self.config.get('max_estimators', 2 * self.n_estimators)
+        self.fitted_srcid_num = 0  # len(self.available_srcids) at the last fit
+        self.fitted_labels = set()
 
         # Init raw data for Zodiac
+        # Srcids outside the snapshot are fetched from the DB.
+        snapshot = self.metadata_snapshot
+        if snapshot and snapshot.covers_query(raw=True,
+                                              srcid__in=self.total_srcids):
+            raw_points = snapshot.bulk_query_rawmetadata(self.total_srcids)
+        else:
+            raw_points = bulk_query_rawmetadata(self.total_srcids, 'metadata')
+        if snapshot and snapshot.covers_query(self.pgid,
+                                              srcid__in=self.total_srcids):
+            self.labeled_cache = snapshot.bulk_query_labels(
+                self.total_srcids, pgid=self.pgid)
+        else:
+            self.labeled_cache = bulk_query_labels(self.total_srcids,
+                                                   POINT_TAGSET, 'tagsets',
+                                                   pgid=self.pgid)
         raw_metadata = defaultdict(dict)
         for srcid in self.total_srcids:
-            raw_point = RawMetadata.objects(srcid=srcid).first()
-            assert raw_point['metadata'], 'Raw metadata for {0} does not exist'.format(srcid)
+            raw_point = raw_points.get(srcid)
+            assert raw_point and raw_point.metadata, \
+                'Raw metadata for {0} does not exist'.format(srcid)
             for metadata_type in self.valid_metadata_types:
                 raw_metadata[metadata_type][srcid] = raw_point.metadata.get(metadata_type, None)
 
         self.total_bow = self.init_bow(self.total_srcids, raw_metadata)
         target_bow = self.get_sub_bow(self.target_srcids)
         self.cluster_map = self.create_cluster_map(target_bow, self.target_srcids)
-        self.training_labels += [self.query_labels(srcid=srcid).first().point_tagset
+        self.training_labels += [self.get_labeled(srcid).point_tagset
                                  for srcid in self.available_srcids]
 
+    def get_labeled(self, srcid):
+        """LabeledMetadata of srcid from the prefetched cache.
+
+        The DB is queried again only if srcid was not labeled at the prefetch
+        time or its point tagset was missing, e.g., labeled later by a UI.
+        """
+        labeled = self.labeled_cache.get(srcid)
+        if not labeled or not labeled.point_tagset:
+            labeled = self.query_labels(srcid=srcid).first()
+            if labeled:
+                self.labeled_cache[srcid] = labeled
+        return labeled
+
+    def add_srcids(self, srcids):
+        for srcid in srcids:
+            if srcid not in self.srcid_idx:
+                self.srcid_idx[srcid] = len(self.total_srcids)
+            self.total_srcids.append(srcid)
+
     def update_thresholds(self):
         self.th_ptr += 1
         self.th_min, self.th_max = self.thresholds[self.th_ptr]
@@ -161,7 +253,7 @@ class ZodiacInterface(object):
     def vectorize(self, d, srcids, vectorizer):
         data = [d[srcid] for srcid in srcids]
         if is_nonempty_item_included(data):
-            vect = vectorizer.fit_transform(data).toarray()
+            vect = vectorizer.fit_transform(data).tocsr()
             return vect
         else:
             return None
@@ -172,20 +264,20 @@ class ZodiacInterface(object):
                                   get_vectorizer(metadata_type),
                                   )
                    for metadata_type in self.valid_metadata_types]
-        bow = np.hstack([vect for vect in vectors if isinstance(vect, np.ndarray)])
+        bow = sparse.hstack([vect for vect in vectors if vect is not None],
+                            format='csr')
         return bow
 
     def create_cluster_map(self, bow, srcids):
         cluster_map = {}
-        z = linkage(bow, metric='cityblock', method='complete')
-        dists = list(set(z[:, 2]))
-        thresh = (dists[1] + dists[2]) / 2
+        self.cluster_idx = {}  # srcid -> cluster id
+        b, thresh = self.clustering(bow)
         self.logger.info('Threshold: {0}'.format(thresh))
-        b = hier.fcluster(z, thresh, criterion='distance')
         assert bow.shape[0] == len(b)
         assert len(b) == len(srcids)
         for cid, srcid in zip(b, srcids):
-            cluster_map[cid] = cluster_map.get(cid, []) + [srcid]
+            cluster_map.setdefault(cid, []).append(srcid)
+            self.cluster_idx[srcid] = cid
 
         self.logger.info('# of clusters: {0}'.format(len(b)))
         self.logger.info('sizes of clustsers:{0}'.format(sorted(map(len, cluster_map.values()))))
@@ -193,22 +285,22 @@ class ZodiacInterface(object):
         return cluster_map
 
     def find_cluster_id(self, srcid):
-        for cid, srcids in self.cluster_map.items():
-            if srcid in srcids:
-                return cid
-        raise Exception('Srcid not found in the cluster map: {0}'
-                        .format(srcid))
+        try:
+            return self.cluster_idx[srcid]
+        except KeyError:
+            raise Exception('Srcid not found in the cluster map: {0}'
+                            .format(srcid))
 
     def get_sub_bow(self, srcids):
-        return self.total_bow[
-            [self.total_srcids.index(srcid) for srcid in srcids]
-        ]
+        idxs = np.fromiter((self.srcid_idx[srcid] for srcid in srcids),
+                           dtype=np.intp, count=len(srcids))
+        return self.total_bow[idxs]
 
     def add_cluster_label(self, cid, label):
         if cid in self.trained_cids:
             self.logger.warning('Cluster already learned: {0}'.format(cid))
             return None
-        self.trained_cids.append(cid)
+        self.trained_cids.add(cid)
         cluster_srcids = self.cluster_map[cid]
         for srcid in cluster_srcids:
             if srcid in self.available_srcids:
@@ -234,7 +326,7 @@ class ZodiacInterface(object):
             cnt += 1
             srcid = triple[0].split('#')[-1]
             tagset = triple[2].split('#')[-1]
-            true_tagset = self.query_labels(srcid=srcid).first().point_tagset
+            true_tagset = self.get_labeled(srcid).point_tagset
             if tagset == true_tagset:
                 acc += 1
         if cnt:
@@ -256,10 +348,9 @@ class ZodiacInterface(object):
     def update_model(self, new_srcids):
         # Add new srcids into the training set.
         for srcid in new_srcids:
-            labeled = self.query_labels(srcid=srcid)
+            labeled = self.get_labeled(srcid)
             if not labeled:
                 raise Exception('Labels do not exist for {0}'.format(srcid))
-            labeled = labeled[0]
             point_tagset = labeled.point_tagset
             if not point_tagset:
                 raise Exception('Point Tagset not found at {0}: {1}'
@@ -285,18 +376,14 @@ class ZodiacInterface(object):
             self.select_informative_samples(1)
 
     def select_srcid_per_cluster(self, srcids):
-        cids = []
+        cids = set()
         for srcid in srcids:
-            srcid_handled = False
-            for cid, cluster in self.cluster_map.items():
-                if srcid in cluster:
-                    if cid not in self.trained_cids:
-                        cids.append(cid)
-                    srcid_handled = True
-                    break
-            assert srcid_handled, "{0}'s cluster is not found".format(srcid)
+            assert srcid in self.cluster_idx, "{0}'s cluster is not found".format(srcid)
+            cid = self.cluster_idx[srcid]
+            if cid not in self.trained_cids:
+                cids.add(cid)
         new_srcids = []
-        cids = list(set(cids))
+        cids = list(cids)
         cluster_sizes = [len(self.cluster_map[cid]) for cid in cids]
         for cid in cids:
             new_srcids.append(random.choice(self.cluster_map[cid]))
@@ -311,14 +398,17 @@ class ZodiacInterface(object):
         # If points in a vav are identified same,
         # remove it from identified list.
         vavs = self.prior_g.get_vavs()
+        target_idx = {}
+        for idx, srcid in enumerate(target_srcids):
+            target_idx.setdefault(srcid, idx)
         cand_srcids = []
         for vav in vavs:
             points = self.prior_g.get_vav_points(vav)
             point_types = defaultdict(list)
             for point in points:
                 srcid = point.split('#')[-1]
-                if srcid in target_srcids:
-                    point_idx = target_srcids.index(srcid)
+                if srcid in target_idx:
+                    point_idx = target_idx[srcid]
                     pred_type = pred[point_idx]
                     point_types[pred_type].append(point)
             for point_type, points in point_types.items():
@@ -327,9 +417,27 @@ class ZodiacInterface(object):
         new_srcids = self.select_srcid_per_cluster(cand_srcids)
         return new_srcids
 
+    def score_clusters(self, cids):
+        """Predict all the members of the given clusters at once.
+
+        Returns each cluster's max confidence and its members' predicted labels.
+        """
+        if not cids:
+            return [], []
+        srcids = [srcid for cid in cids for srcid in self.cluster_map[cid]]
+        sizes = [len(self.cluster_map[cid]) for cid in cids]
+        offsets = np.cumsum([0] + sizes)
+        proba = self.model.predict_proba(self.get_sub_bow(srcids))
+        max_confidences = np.maximum.reduceat(proba.max(axis=1), offsets[:-1])
+        pred_labels = self.model.classes_[proba.argmax(axis=1)]
+        cluster_pred_labels = [pred_labels[begin:end]
+                               for begin, end in zip(offsets[:-1], offsets[1:])]
+        return max_confidences, cluster_pred_labels
+
     def select_informative_samples(self, sample_num=1):
         new_srcids = []
-        tot_srcids = reduce(adder, self.cluster_map.values())
+        tot_srcids = [srcid for cluster_srcids in self.cluster_map.values()
+                      for srcid in cluster_srcids]
         base_sample_bow = self.get_sub_bow(tot_srcids)
         base_pred_labels = self.model.predict(base_sample_bow)
         new_srcids = self.apply_prior_quiver(base_pred_labels, tot_srcids)
@@ -343,14 +451,12 @@ class ZodiacInterface(object):
             th_update_flag = True
             prev_available_srcids = deepcopy(self.available_srcids)
             self.logger.info('curr availble srcids: {0}'.format(len(prev_available_srcids)))
-            for cid, cluster_srcids in self.cluster_map.items():
-                if cid in self.trained_cids:
-                    continue
-                sample_bow = self.get_sub_bow(cluster_srcids)
-                confidence = self.model.predict_proba(sample_bow)
-                pred_labels = self.model.predict(sample_bow)
-                max_confidence = 0
-                max_confidence = max(map(max, confidence))
+            cids = [cid for cid in self.cluster_map if cid not in self.trained_cids]
+            max_confidences, cluster_pred_labels = self.score_clusters(cids)
+            for cid, max_confidence, pred_labels in zip(cids,
+                                                        max_confidences,
+                                                        cluster_pred_labels):
+                cluster_srcids = self.cluster_map[cid]
 
                 if max_confidence >= self.th_min and max_confidence < self.th_max:  # Gray zone
                     pass
@@ -359,7 +465,7 @@ class ZodiacInterface(object):
                         raise AlgorithmError(self, 'infinite loop found.')
                     th_update_flag = False
                     test_flag = cluster_srcids
-                    self.trained_cids.append(cid)
+                    self.trained_cids.add(cid)
                     self.available_srcids += cluster_srcids
                     self.training_labels += pred_labels.tolist()
                     # Check true label for debugging
@@ -447,8 +553,23 @@ class ZodiacInterface(object):
         if not self.available_srcids:
             self.logger.warning('not learning anything due to the empty training data')
             return False
+        if len(self.available_srcids) == self.fitted_srcid_num:
+            # available_srcids only grows, so nothing is new since the last fit.
+            return True
         self.training_bow = self.get_sub_bow(self.available_srcids)
+        labels = set(self.training_labels)
+        # Trees from an earlier fit only know the labels seen at that time,
+        # so a new label always requires a full retraining.
+        if self.incremental_training and self.fitted_srcid_num \
+                and labels == self.fitted_labels \
+                and self.model.n_estimators + self.n_estimators_inc <= self.max_estimators:
+            self.model.set_params(warm_start=True,
+                                  n_estimators=self.model.n_estimators + self.n_estimators_inc)
+        else:
+            self.model.set_params(warm_start=False, n_estimators=self.n_estimators)
         self.model.fit(self.training_bow, self.training_labels)
+        self.fitted_srcid_num = len(self.available_srcids)
+        self.fitted_labels = labels
         return True
 
     def predict(self, target_srcids=None, output_format='ttl'):
@@ -463,11 +584,8 @@ class ZodiacInterface(object):
 
         pred_points = self.model.predict(sample_bow)
         confidences = self.model.predict_proba(sample_bow)
-        for srcid, pred_point, prob in zip(target_srcids,
-                                           pred_points,
-                                           confidences):
-            prob = max(prob)
-            self.add_pred(pred_g, pred_confidences, srcid, pred_point, prob)
+        self.add_preds(pred_g, pred_confidences, target_srcids, pred_points,
+                       [max(prob) for prob in confidences])
         self.pred_g = pred_g
         self.pred_confidences = pred_confidences
         t1 = arrow.get()
@@ -1,35 +1,16 @@
 import pdb
+import weakref
 
-from mongoengine import connect, Document, StringField, DictField, ListField
+import numpy as np
 import pandas as pd
 from tabulate import tabulate
 
 from .common import FULL_PARSING, POINT_TAGSET, ALL_TAGSETS
+# The data models come from the store selected by METADATA_STORE_TYPE.
+from .metadata_store import RawMetadata, LabeledMetadata, bulk_upsert
 
 pd.options.display.max_colwidth = 200
 
-connect('plastering-withpg')
-
-
-# Data Models
-
-class RawMetadata(Document):
-    srcid = StringField(required=True)
-    building = StringField(required=True)
-    metadata = DictField()
-    meta = {'allow_inheritance': True}
-
-
-class LabeledMetadata(Document):
-    srcid = StringField(required=True)
-    building = StringField(required=True)
-    fullparsing = DictField(default={})
-    tagsets = ListField(StringField(), default=[])
-    point_tagset = StringField()
-    tagsets_parsing = DictField(default={})
-    pgid = StringField()
-    meta = {'allow_inheritance': True}
-
 
 # Helper functions
 
@@ -40,6 +21,342 @@ def query_labels(pgid=None, **query):
         return LabeledMetadata.objects(**query)
 
 
+def _index_by_srcid(docs):
+    # Keep the first document per srcid as `.first()` would do.
+    res = {}
+    for doc in docs:
+        res.setdefault(doc.srcid, doc)
+    return res
+
+
+def bulk_query_rawmetadata(srcids, *fields, **query):
+    """Fetch RawMetadata of all the srcids with a single query.
+
+    Only the given fields (and srcid) are loaded if any are given.
+    Returns a dict of srcid -> RawMetadata.
+    """
+    docs = RawMetadata.objects(srcid__in=list(srcids), **query)
+    if fields:
+        docs = docs.only('srcid', *fields)
+    return _index_by_srcid(docs)
+
+
+def bulk_query_labels(srcids, *fields, pgid=None, **query):
+    """Fetch LabeledMetadata of all the srcids with a single query.
+
+    Only the given fields (and srcid) are loaded if any are given.
+    Returns a dict of srcid -> LabeledMetadata. Unlabeled srcids are omitted.
+    """
+    docs = query_labels(pgid=pgid, srcid__in=list(srcids), **query)
+    if fields:
+        docs = docs.only('srcid', *fields)
+    return _index_by_srcid(docs)
+
+
+# In-memory snapshots
+
+_snapshots = weakref.WeakSet()  # Snapshots to refresh on insert_groundtruth
+
+
+def _object_array(values):
+    # np.array would make a 2-D array out of equal-length lists.
+    arr = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+
+class SnapshotDoc(object):
+    """A read-only document served by MetadataSnapshot.
+
+    Fields can be read as attributes or items like mongoengine Documents.
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<SnapshotDoc: {0}>'.format(self.srcid)
+
+
+class SnapshotQuerySet(list):
+    """A list of SnapshotDocs with the QuerySet methods used in Plastering."""
+    def first(self):
+        return self[0] if self else None
+
+    def count(self):
+        return len(self)
+
+
+class MetadataSnapshot(object):
+    """Columnar in-memory copy of RawMetadata and LabeledMetadata.
+
+    It loads a building or a list of buildings (or a pgid slice, or both)
+    with one query per collection and answers the same queries as query_labels from memory.
+    Labels inserted through insert_groundtruth are refreshed in place.
+
+    Raw metadata rows are keyed by srcid and label rows by (srcid, pgid).
+    Columns:
+    - srcids, buildings: srcid and building of every raw row
+    - metadata: metadata_type -> raw metadata of every raw row (None if not given)
+    - label_srcids, label_buildings, pgids: keys of every label row
+    - point_tagset_codes: index in point_tagset_vocab (-1 if not given)
+    - tagsets, fullparsing, tagsets_parsing: labels of every label row
+    Only the first label_num label rows are in use; the label columns grow
+    by doubling so that new labels are appended in amortized constant time.
+    """
+    def __init__(self, building=None, pgid=None, metadata_types=None,
+                 load_parsing=True):
+        assert building or pgid, 'Either building or pgid should be given'
+        if isinstance(building, str):
+            building = [building]
+        self.loaded_buildings = building  # None means all buildings in the pgid.
+        self.pgid = pgid
+        self.metadata_types = metadata_types
+        self.load_parsing = load_parsing  # fullparsing and tagsets_parsing
+        self.load()
+        _snapshots.add(self)
+
+    def covers(self, building, pgid=None):
+        """True if all the labels of building (in pgid if given) are loaded."""
+        if self.pgid and pgid != self.pgid:
+            return False
+        return not self.loaded_buildings or building in self.loaded_buildings
+
+    def covers_query(self, pgid=None, raw=False, **query):
+        """True if the query can be answered from memory.
+
+        Without a building in the query, every srcid in it should be loaded.
+        Raw metadata of a building is complete only if the building is loaded.
+        """
+        if not raw and self.pgid and pgid != self.pgid:
+            return False
+        if 'building' in query:
+            buildings = [query['building']]
+        elif 'building__in' in query:
+            buildings = query['building__in']
+        else:
+            buildings = None
+        if buildings is not None:
+            if self.loaded_buildings:
+                return all(building in self.loaded_buildings
+                           for building in buildings)
+            elif not raw:
+                return True
+        if 'srcid' in query:
+            srcids = [query['srcid']]
+        elif 'srcid__in' in query:
+            srcids = query['srcid__in']
+        else:
+            return False
+        return all(srcid in self.srcid_idx or srcid in self.label_rows
+                   for srcid in srcids)
+
+    def _label_query(self, pgid=None, **query):
+        if self.loaded_buildings:
+            query['building__in'] = self.loaded_buildings
+        docs = query_labels(pgid=pgid or self.pgid, **query)
+        if not self.load_parsing:
+            docs = docs.exclude(FULL_PARSING, 'tagsets_parsing')
+        return docs
+
+    def load(self):
+        labeled_docs = {}
+        for doc in self._label_query():
+            labeled_docs.setdefault((doc.srcid, doc.pgid), doc)
+        if self.loaded_buildings:
+            raw_docs = RawMetadata.objects(building__in=self.loaded_buildings)\
+                .only('srcid', 'building', 'metadata')
+            raw_docs = _index_by_srcid(raw_docs)
+        else:
+            raw_docs = bulk_query_rawmetadata(
+                {srcid for srcid, _ in labeled_docs}, 'building', 'metadata')
+        if self.metadata_types is None:
+            self.metadata_types = sorted({metadata_type
+                                          for doc in raw_docs.values()
+                                          for metadata_type in doc.metadata})
+        srcids = list(raw_docs.keys())
+        n = len(srcids)
+        self.srcids = _object_array(srcids)
+        self.srcid_idx = {srcid: i for i, srcid in enumerate(srcids)}
+        self.buildings = _object_array([raw_docs[srcid].building
+                                        for srcid in srcids])
+        self.metadata = {metadata_type: _object_array(
+                             [raw_docs[srcid].metadata.get(metadata_type)
+                              for srcid in srcids])
+                         for metadata_type in self.metadata_types}
+
+        keys = list(labeled_docs.keys())
+        m = len(keys)
+        self.label_idx = {key: i for i, key in enumerate(keys)}
+        self.label_rows = {}  # srcid -> label rows of the srcid in any pgid
+        for i, (srcid, _) in enumerate(keys):
+            self.label_rows.setdefault(srcid, []).append(i)
+        self.label_srcids = _object_array([srcid for srcid, _ in keys])
+        self.label_buildings = _object_array([None] * m)
+        self.pgids = _object_array([pgid for _, pgid in keys])
+        self.point_tagset_vocab = []
+        self.point_tagset_ids = {}
+        self.point_tagset_codes = np.full(m, -1, dtype=np.int32)
+        self.tagsets = _object_array([[] for _ in range(m)])
+        self.fullparsing = _object_array([{} for _ in range(m)])
+        self.tagsets_parsing = _object_array([{} for _ in range(m)])
+        # Label rows in use. The columns may have spare rows at the end.
+        self.label_num = m
+        for key, doc in labeled_docs.items():
+            self._set_label_row(self.label_idx[key], doc)
+
+    def _encode_point_tagset(self, point_tagset):
+        if not point_tagset:
+            return -1
+        if point_tagset not in self.point_tagset_ids:
+            self.point_tagset_ids[point_tagset] = len(self.point_tagset_vocab)
+            self.point_tagset_vocab.append(point_tagset)
+        return self.point_tagset_ids[point_tagset]
+
+    def _set_label_row(self, i, doc):
+        self.label_buildings[i] = doc.building
+        self.point_tagset_codes[i] = self._encode_point_tagset(doc.point_tagset)
+        self.tagsets[i] = list(doc.tagsets or [])
+        if self.load_parsing:
+            self.fullparsing[i] = doc.fullparsing or {}
+            self.tagsets_parsing[i] = doc.tagsets_parsing or {}
+
+    def _grow_label_columns(self):
+        # Doubling the capacity keeps adding rows amortized O(1).
+        spare = max(len(self.label_srcids), 16)
+        for name in ['label_srcids', 'label_buildings', 'pgids', 'tagsets',
+                     'fullparsing', 'tagsets_parsing']:
+            setattr(self, name, np.concatenate([getattr(self, name),
+                                                _object_array([None] * spare)]))
+        self.point_tagset_codes = np.concatenate(
+            [self.point_tagset_codes, np.full(spare, -1, dtype=np.int32)])
+
+    def _add_label_row(self, srcid, pgid):
+        i = self.label_num
+        if i == len(self.label_srcids):
+            self._grow_label_columns()
+        self.label_num += 1
+        self.label_idx[(srcid, pgid)] = i
+        self.label_rows.setdefault(srcid, []).append(i)
+        self.label_srcids[i] = srcid
+        self.pgids[i] = pgid
+        self.tagsets[i] = []
+        self.fullparsing[i] = {}
+        self.tagsets_parsing[i] = {}
+        return i
+
+    def invalidate(self, srcid, building, pgid):
+        """Reload the labels of srcid in pgid if they belong to this snapshot."""
+        if not self.covers(building, pgid):
+            return
+        doc = self._label_query(srcid=srcid, pgid=pgid).first()
+        if not doc:
+            return
+        if (srcid, pgid) in self.label_idx:
+            i = self.label_idx[(srcid, pgid)]
+        else:
+            i = self._add_label_row(srcid, pgid)
+        self._set_label_row(i, doc)
+
+    def _label_doc(self, i):
+        code = self.point_tagset_codes[i]
+        return SnapshotDoc(
+            srcid=self.label_srcids[i],
+            building=self.label_buildings[i],
+            pgid=self.pgids[i],
+            point_tagset=self.point_tagset_vocab[code] if code >= 0 else None,
+            tagsets=self.tagsets[i],
+            fullparsing=self.fullparsing[i],
+            tagsets_parsing=self.tagsets_parsing[i],
+        )
+
+    def _raw_doc(self, i):
+        metadata = {metadata_type: column[i]
+                    for metadata_type, column in self.metadata.items()
+                    if column[i] is not None}
+        return SnapshotDoc(srcid=self.srcids[i],
+                           building=self.buildings[i],
+                           metadata=metadata,
+                           )
+
+    def _column(self, field, labels):
+        if field == 'srcid':
+            return self.label_srcids[:self.label_num] if labels else self.srcids
+        elif field == 'building':
+            return (self.label_buildings[:self.label_num] if labels
+                    else self.buildings)
+        elif field == 'pgid' and labels:
+            return self.pgids[:self.label_num]
+        elif field == 'point_tagset' and labels:
+            vocab = _object_array(self.point_tagset_vocab + [None])
+            # -1 points None.
+            return vocab[self.point_tagset_codes[:self.label_num]]
+        else:
+            raise Exception('Query on {0} is not supported by MetadataSnapshot'
+                            .format(field))
+
+    def _select(self, query, labels):
+        """Row indices of the label (or raw) rows matching a mongoengine-style
+        query."""
+        if 'srcid' in query or 'srcid__in' in query:
+            srcids = [query['srcid']] if 'srcid' in query \
+                else query['srcid__in']
+            if labels:
+                idxs = [i for srcid in srcids
+                        for i in self.label_rows.get(srcid, [])]
+            else:
+                idxs = [self.srcid_idx[srcid] for srcid in srcids
+                        if srcid in self.srcid_idx]
+            query = {key: value for key, value in query.items()
+                     if key.partition('__')[0] != 'srcid'}
+        else:
+            idxs = range(self.label_num if labels else len(self.srcids))
+        idxs = np.asarray(idxs, dtype=np.intp)
+        for key, value in query.items():
+            field, _, op = key.partition('__')
+            values = self._column(field, labels)[idxs]
+            if op == 'in':
+                value = set(value)
+                matched = np.fromiter((v in value for v in values),
+                                      dtype=bool, count=len(values))
+            elif not op:
+                matched = values == value
+            else:
+                raise Exception('Operator {0} is not supported by MetadataSnapshot'
+                                .format(op))
+            idxs = idxs[np.asarray(matched, dtype=bool)]
+        return idxs
+
+    def query_labels(self, pgid=None, **query):
+        """Same as query_labels but served from memory."""
+        if pgid:
+            query['pgid'] = pgid
+        return SnapshotQuerySet(self._label_doc(i)
+                                for i in self._select(query, labels=True))
+
+    def query_rawmetadata(self, **query):
+        """Same as RawMetadata.objects(**query) but served from memory."""
+        return SnapshotQuerySet(self._raw_doc(i)
+                                for i in self._select(query, labels=False))
+
+    def bulk_query_labels(self, srcids, *fields, pgid=None, **query):
+        """Same as bulk_query_labels but served from memory."""
+        return _index_by_srcid(self.query_labels(pgid=pgid, srcid__in=srcids, **query))
+
+    def bulk_query_rawmetadata(self, srcids, *fields, **query):
+        """Same as bulk_query_rawmetadata but served from memory."""
+        return _index_by_srcid(self.query_rawmetadata(srcid__in=srcids, **query))
+
+    def get_point_tagsets(self, srcids, pgid=None):
+        """Point tagsets of the srcids (None if not labeled) in one pass."""
+        docs = self.bulk_query_labels(srcids, pgid=pgid)
+        return [docs[srcid].point_tagset if srcid in docs else None
+                for srcid in srcids]
+
+
 def print_rawmetadata(srcid, building):
     objs = RawMetadata.objects(srcid=srcid, building=building)
     metadata = objs[0].metadata
@@ -83,6 +400,48 @@ def insert_groundtruth(srcid, building, pgid,
     if tagsets:
         obj[ALL_TAGSETS] = tagsets
     obj.save()
+    for snapshot in list(_snapshots):
+        snapshot.invalidate(srcid, building, pgid)
+
+
+def _reload_snapshots(building, pgid=None):
+    for snapshot in list(_snapshots):
+        if not snapshot.loaded_buildings \
+                or building in snapshot.loaded_buildings:
+            if pgid is None or snapshot.covers(building, pgid):
+                snapshot.load()
+
+
+def bulk_insert_rawmetadata(building, metadata_dict, batch_size=1000,
+                            merge=False):
+    """Upsert raw metadata of many points with batched writes.
+
+    metadata_dict: srcid -> metadata (dict of metadata_type -> value).
+    The metadata of an existing point is replaced, or updated per
+    metadata_type if merge is True.
+    """
+    if merge:
+        docs = [dict({'metadata.' + metadata_type: value
+                      for metadata_type, value in metadata.items()},
+                     srcid=srcid, building=building)
+                for srcid, metadata in metadata_dict.items()]
+    else:
+        docs = [{'srcid': srcid, 'building': building, 'metadata': metadata}
+                for srcid, metadata in metadata_dict.items()]
+    bulk_upsert(RawMetadata, docs, ['srcid', 'building'], batch_size)
+    _reload_snapshots(building)
+
+
+def bulk_insert_groundtruth(building, pgid, labels_dict, batch_size=1000):
+    """Upsert labels of many points with batched writes.
+
+    labels_dict: srcid -> dict of the labels to set among fullparsing,
+    tagsets and point_tagset. Labels not given are kept as they are.
+    """
+    docs = [dict(labels, srcid=srcid, building=building, pgid=pgid)
+            for srcid, labels in labels_dict.items()]
+    bulk_upsert(LabeledMetadata, docs, ['srcid', 'building', 'pgid'], batch_size)
+    _reload_snapshots(building, pgid)
 
 
 def get_or_create(doc_type, **query):
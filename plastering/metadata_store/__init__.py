@@ -0,0 +1,14 @@
+import os
+
+
+MONGODB = 'mongodb'
+SQLITE = 'sqlite'
+METADATA_STORE_TYPE = os.environ.get('METADATA_STORE_TYPE', MONGODB)
+
+if METADATA_STORE_TYPE == MONGODB:
+    from .mongodb_store import *
+elif METADATA_STORE_TYPE == SQLITE:
+    from .sqlite_store import *
+else:
+    raise Exception('Metadata store type not defined for: {0}'
+                    .format(METADATA_STORE_TYPE))
@@ -0,0 +1,60 @@
+import os
+
+from mongoengine import register_connection, DEFAULT_CONNECTION_NAME
+from mongoengine import Document, StringField, DictField, ListField
+from pymongo import UpdateOne
+
+from ..helpers import chunks
+
+__all__ = ['RawMetadata', 'LabeledMetadata', 'bulk_upsert']
+
+DB_NAME = os.environ.get('METADATA_DB_NAME', 'plastering-withpg')
+
+# Only registered here. mongoengine connects on the first query.
+register_connection(DEFAULT_CONNECTION_NAME, db=DB_NAME)
+
+
+# Data Models
+
+class RawMetadata(Document):
+    srcid = StringField(required=True)
+    building = StringField(required=True)
+    metadata = DictField()
+    meta = {
+        'allow_inheritance': True,
+        # Indexes without _cls also serve bulk_upsert's filters.
+        'index_cls': False,
+        'indexes': [('building', 'srcid'), 'srcid'],
+    }
+
+
+class LabeledMetadata(Document):
+    srcid = StringField(required=True)
+    building = StringField(required=True)
+    fullparsing = DictField(default={})
+    tagsets = ListField(StringField(), default=[])
+    point_tagset = StringField()
+    tagsets_parsing = DictField(default={})
+    pgid = StringField()
+    meta = {
+        'allow_inheritance': True,
+        'index_cls': False,
+        'indexes': [('building', 'srcid', 'pgid'), ('srcid', 'pgid'), 'pgid'],
+    }
+
+
+def bulk_upsert(doc_type, docs, key_fields, batch_size=1000):
+    """Upsert docs (dicts of fields) matched by key_fields with bulk_write.
+
+    Each batch is one unordered bulk_write. The given fields replace the
+    stored ones and the others are kept. A dotted field such as
+    `metadata.VendorGivenName` sets a key inside a dict field.
+    """
+    collection = doc_type._get_collection()
+    for batch in chunks(docs, batch_size):
+        ops = [UpdateOne({field: doc.get(field) for field in key_fields},
+                         # _cls is what mongoengine filters inherited documents by.
+                         {'$set': dict(doc, _cls=doc_type._class_name)},
+                         upsert=True)
+               for doc in batch]
+        collection.bulk_write(ops, ordered=False)
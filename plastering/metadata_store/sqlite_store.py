@@ -0,0 +1,285 @@
+import os
+import json
+import sqlite3
+
+from ..helpers import chunks
+
+__all__ = ['RawMetadata', 'LabeledMetadata', 'bulk_upsert']
+
+DB_FILE = os.environ.get('METADATA_SQLITE_FILE', 'plastering-withpg.sqlite3')
+
+_conn = None
+
+
+def get_connection():
+    """Open the database on the first use and create the tables if needed."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_FILE)
+        for doc_type in [RawMetadata, LabeledMetadata]:
+            doc_type._create_table(_conn)
+    return _conn
+
+
+class QuerySet(object):
+    """A subset of mongoengine's QuerySet interface over a SQLite table.
+
+    Supported queries are equalities and `__in` on the scalar fields, e.g.,
+    `LabeledMetadata.objects(building='ap_m', srcid__in=srcids)`.
+    """
+    def __init__(self, doc_type, query, fields=None):
+        self.doc_type = doc_type
+        self.query = query
+        self.fields = fields or doc_type._fields
+
+    def _where(self):
+        clauses = []
+        params = []
+        for key, value in self.query.items():
+            field, _, op = key.partition('__')
+            if field != 'id' and (field not in self.doc_type._fields
+                                  or field in self.doc_type._json_fields):
+                raise Exception('Query on {0} is not supported by {1}'
+                                .format(field, self.doc_type.__name__))
+            if op == 'in':
+                # A single JSON parameter avoids SQLite's limit on the number
+                # of variables in a query.
+                clauses.append('{0} IN (SELECT value FROM json_each(?))'.format(field))
+                params.append(json.dumps(list(value)))
+            elif op:
+                raise Exception('Operator {0} is not supported by {1}'
+                                .format(op, self.doc_type.__name__))
+            elif value is None:
+                clauses.append('{0} IS NULL'.format(field))
+            else:
+                clauses.append('{0} = ?'.format(field))
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def _select(self, limit=-1, offset=0):
+        where, params = self._where()
+        qstr = 'SELECT id, {0} FROM {1}{2} ORDER BY id LIMIT ? OFFSET ?'\
+            .format(', '.join(self.fields), self.doc_type._table, where)
+        rows = get_connection().execute(qstr, params + [limit, offset])
+        return [self.doc_type._from_row(self.fields, row) for row in rows]
+
+    def __iter__(self):
+        return iter(self._select())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            assert key.step is None, 'Slicing steps are not supported'
+            start = key.start or 0
+            if key.stop is None:
+                return self._select(offset=start)  # LIMIT -1 is no limit.
+            return self._select(limit=max(key.stop - start, 0), offset=start)
+        docs = self._select(limit=1, offset=key)
+        if not docs:
+            raise IndexError('No document at {0}'.format(key))
+        return docs[0]
+
+    def __bool__(self):
+        return self.first() is not None
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        where, params = self._where()
+        qstr = 'SELECT COUNT(*) FROM {0}{1}'.format(self.doc_type._table, where)
+        return get_connection().execute(qstr, params).fetchone()[0]
+
+    def first(self):
+        docs = self._select(limit=1)
+        return docs[0] if docs else None
+
+    def only(self, *fields):
+        fields = [field for field in self.doc_type._fields if field in fields]
+        return QuerySet(self.doc_type, self.query, fields)
+
+    def exclude(self, *fields):
+        fields = [field for field in self.fields if field not in fields]
+        return QuerySet(self.doc_type, self.query, fields)
+
+    def upsert_one(self, **values):
+        doc = self.first()
+        if not doc:
+            doc = self.doc_type(**{key: value for key, value in self.query.items()
+                                   if '__' not in key})
+        for key, value in values.items():
+            doc[key] = value
+        doc.save()
+        return doc
+
+    def delete(self):
+        where, params = self._where()
+        with get_connection() as conn:
+            conn.execute('DELETE FROM {0}{1}'.format(self.doc_type._table, where),
+                         params)
+
+
+class Document(object):
+    """A row of a SQLite table accessed like a mongoengine Document.
+
+    `_fields` maps each field to its default value factory (None if the
+    default is None) and `_json_fields` are the fields stored as JSON text.
+    """
+    _table = None
+    _fields = {}
+    _json_fields = []
+    _indexes = []
+
+    def __init__(self, id=None, **values):
+        self.id = id
+        self._loaded_fields = list(self._fields)
+        for field, default in self._fields.items():
+            if field in values:
+                setattr(self, field, values[field])
+            else:
+                setattr(self, field, default() if default else None)
+
+    @classmethod
+    def _create_table(cls, conn):
+        columns = ', '.join('{0} TEXT'.format(field) for field in cls._fields)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {0} (id INTEGER PRIMARY KEY, {1})'
+                         .format(cls._table, columns))
+            for index in cls._indexes:
+                conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({2})'
+                             .format(cls._table, '_'.join(index), ', '.join(index)))
+
+    @classmethod
+    def _from_row(cls, fields, row):
+        values = {}
+        for field, value in zip(fields, row[1:]):
+            if field in cls._json_fields and value is not None:
+                value = json.loads(value)
+            values[field] = value
+        doc = cls(id=row[0], **values)
+        doc._loaded_fields = fields
+        return doc
+
+    @classmethod
+    def objects(cls, **query):
+        return QuerySet(cls, query)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def _values(self, fields):
+        return [json.dumps(self[field]) if field in self._json_fields else self[field]
+                for field in fields]
+
+    def save(self):
+        # Only the loaded fields are written back, as with a projected
+        # mongoengine document.
+        with get_connection() as conn:
+            if self.id is None:
+                fields = list(self._fields)
+                cur = conn.execute('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                    self._table, ', '.join(fields), ', '.join(['?'] * len(fields))),
+                    self._values(fields))
+                self.id = cur.lastrowid
+            else:
+                fields = self._loaded_fields
+                conn.execute('UPDATE {0} SET {1} WHERE id = ?'.format(
+                    self._table, ', '.join('{0} = ?'.format(field) for field in fields)),
+                    self._values(fields) + [self.id])
+        return self
+
+    def delete(self):
+        with get_connection() as conn:
+            conn.execute('DELETE FROM {0} WHERE id = ?'.format(self._table), [self.id])
+
+
+# Data Models
+
+class RawMetadata(Document):
+    _table = 'raw_metadata'
+    _fields = {
+        'srcid': None,
+        'building': None,
+        'metadata': dict,
+    }
+    _json_fields = ['metadata']
+    _indexes = [('building', 'srcid'), ('srcid',)]
+
+
+class LabeledMetadata(Document):
+    _table = 'labeled_metadata'
+    _fields = {
+        'srcid': None,
+        'building': None,
+        'fullparsing': dict,
+        'tagsets': list,
+        'point_tagset': None,
+        'tagsets_parsing': dict,
+        'pgid': None,
+    }
+    _json_fields = ['fullparsing', 'tagsets', 'tagsets_parsing']
+    _indexes = [('building', 'srcid', 'pgid'), ('srcid', 'pgid'), ('pgid',)]
+
+
+def bulk_upsert(doc_type, docs, key_fields, batch_size=1000):
+    """Upsert docs (dicts of fields) matched by key_fields in batches.
+
+    Each batch is one transaction: a lookup of the existing rows, then
+    batched UPDATEs and INSERTs. The given fields replace the stored ones
+    and the others are kept. A dotted field such as
+    `metadata.VendorGivenName` sets a key inside a JSON field.
+    key_fields should include srcid.
+    """
+    conn = get_connection()
+    table = doc_type._table
+    for batch in chunks(docs, batch_size):
+        with conn:
+            rows = conn.execute(
+                'SELECT id, {0} FROM {1} WHERE srcid IN (SELECT value FROM json_each(?)) '
+                'ORDER BY id DESC'.format(', '.join(key_fields), table),
+                [json.dumps([doc['srcid'] for doc in batch])])
+            # Descending ids leave the first row per key as upsert_one does.
+            row_ids = {tuple(row[1:]): row[0] for row in rows}
+            updates = {}
+            inserts = {}  # key -> fields, merging the docs of a same new key
+            for doc in batch:
+                key = tuple(doc.get(field) for field in key_fields)
+                row_id = row_ids.get(key)
+                if row_id is None:
+                    insert = inserts.setdefault(key, {})
+                    for field, value in doc.items():
+                        field, _, sub_key = field.partition('.')
+                        if sub_key:
+                            insert.setdefault(field, {})[sub_key] = value
+                        else:
+                            insert[field] = value
+                else:
+                    fields = tuple(field for field in doc_type._fields if field in doc)
+                    sub_fields = tuple(sorted(field for field in doc if '.' in field))
+                    params = doc_type(**doc)._values(fields)
+                    for sub_field in sub_fields:
+                        params += ['$."{0}"'.format(sub_field.partition('.')[2]),
+                                   json.dumps(doc[sub_field])]
+                    updates.setdefault((fields, sub_fields), []).append(
+                        params + [row_id])
+            for (fields, sub_fields), params in updates.items():
+                assignments = ['{0} = ?'.format(field) for field in fields]
+                json_sets = {}  # field -> the number of keys set in it
+                for sub_field in sub_fields:
+                    field = sub_field.partition('.')[0]
+                    json_sets[field] = json_sets.get(field, 0) + 1
+                assignments += [
+                    "{0} = json_set(COALESCE({0}, '{{}}'){1})"
+                    .format(field, ', ?, json(?)' * num)
+                    for field, num in json_sets.items()]
+                conn.executemany('UPDATE {0} SET {1} WHERE id = ?'.format(
+                    table, ', '.join(assignments)), params)
+            if inserts:
+                conn.executemany('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                    table, ', '.join(doc_type._fields),
+                    ', '.join(['?'] * len(doc_type._fields))),
+                    [doc_type(**doc)._values(doc_type._fields)
+                     for doc in inserts.values()])
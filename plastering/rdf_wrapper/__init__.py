@@ -1,7 +1,9 @@
 import os
 import time
+from functools import lru_cache
+from collections import defaultdict
 
-from rdflib import RDF, RDFS, OWL, URIRef, Namespace
+from rdflib import Graph, RDF, RDFS, OWL, URIRef, Namespace
 from . import rdflib_wrapper
 from . import virtuoso_wrapper
 
@@ -19,26 +21,103 @@ else:
                     .format(TRIPLE_STORE_TYPE))
 
 
-def get_top_class(point_tagset):
-    if isinstance(point_tagset, URIRef):
-        base_class = point_tagset.split('#')[-1].split('_')[-1]
-    elif isinstance(point_tagset, str):
-        base_class = point_tagset.split('_')[-1]
-        point_tagset = BRICK[point_tagset]
-    else:
-        raise Exception('Behavior not defined for {0}'.format(point_tagset))
-    base_tagset = BRICK[base_class]
-    if base_class in ['sensor', 'meter']:
-        qstr = """
-        select ?superclass where {{
-        ?superclass rdfs:subClassOf {0}.
-        {1} rdfs:subClassOf* ?superclass.
-        }}
-        """.format(base_tagset.n3(), point_tagset.n3())
-        res = query_sparql(schema_g, qstr)
-        assert res, 'No super class found for {0}'.format(point_tagset)
-        base_class = res[0]['superclass'].split('#')[-1]
-    return base_class
+DEFAULT_BRICK_VERSION = '1.0.2'
+DEFAULT_BRICK_FILE = 'brick/Brick_1_0_2.ttl'
+DEFAULT_BRICKFRAME_FILE = 'brick/BrickFrame_1_0_2.ttl'
+# Point tagsets under these classes take their direct subclasses as top classes.
+TOP_CLASS_BASES = ['sensor', 'meter']
+TOP_CLASS_CACHE_SIZE = 10000
+# (version, brick_file, brickframe_file) -> tagset -> top class
+_top_class_tables = {}
+
+
+def get_top_class_table(version=DEFAULT_BRICK_VERSION,
+                        brick_file=DEFAULT_BRICK_FILE,
+                        brickframe_file=DEFAULT_BRICKFRAME_FILE):
+    """Map every tagset under TOP_CLASS_BASES to its top class.
+
+    It is built once per schema from the subclass hierarchy of the schema
+    graph shared with the rdflib backend. Tagsets are lowercase as in
+    LabeledMetadata.
+    """
+    key = (version, brick_file, brickframe_file)
+    if key not in _top_class_tables:
+        schema_g = rdflib_wrapper.get_schema_graph(brick_file, brickframe_file)
+        subclasses = defaultdict(set)
+        for child, _, parent in schema_g.triples((None, RDFS.subClassOf, None)):
+            subclasses[parse_srcid(parent).lower()].add(
+                parse_srcid(child).lower())
+        candidates = defaultdict(set)
+        for base_class in TOP_CLASS_BASES:
+            for top_class in subclasses[base_class]:
+                tagsets = [top_class]
+                while tagsets:
+                    tagset = tagsets.pop()
+                    if top_class in candidates[tagset]:
+                        continue
+                    candidates[tagset].add(top_class)
+                    tagsets += subclasses[tagset]
+        # With several parents, e.g., ahu_co2_sensor under both co2_sensor and
+        # co2_differential_sensor, the top class named by the tagset wins.
+        _top_class_tables[key] = {
+            tagset: max(sorted(top_classes), key=lambda top_class:
+                        ('_' + tagset).endswith('_' + top_class))
+            for tagset, top_classes in candidates.items()}
+    return _top_class_tables[key]
+
+
+@lru_cache(maxsize=TOP_CLASS_CACHE_SIZE)
+def _find_top_class(tagset, table_key):
+    # A tagset unknown to the schema takes the top class of its longest
+    # known suffix, e.g., supply_air_temperature_sensor -> temperature_sensor.
+    table = _top_class_tables[table_key]
+    words = tagset.split('_')
+    for i in range(1, len(words)):
+        suffix = '_'.join(words[i:])
+        if suffix in table:
+            print('WARNING: {0} is not in the schema. {1} is guessed from {2}'
+                  .format(tagset, table[suffix], suffix))
+            return table[suffix]
+    raise Exception('No super class found for {0}'.format(tagset))
+
+
+def get_top_classes(point_tagsets,
+                    version=DEFAULT_BRICK_VERSION,
+                    brick_file=DEFAULT_BRICK_FILE,
+                    brickframe_file=DEFAULT_BRICKFRAME_FILE,
+                    guess_unknown=False):
+    """Top classes of point tagsets (str or URIRef), e.g., temperature_sensor
+    for zone_temperature_sensor. A tagset outside TOP_CLASS_BASES is mapped
+    to its last word such as setpoint.
+
+    A sensor or meter tagset unknown to the schema raises an Exception,
+    unless guess_unknown is set to take the top class of its longest known
+    suffix.
+    """
+    table = get_top_class_table(version, brick_file, brickframe_file)
+    table_key = (version, brick_file, brickframe_file)
+    top_classes = []
+    for point_tagset in point_tagsets:
+        if isinstance(point_tagset, URIRef):
+            tagset = parse_srcid(point_tagset).lower()
+        elif isinstance(point_tagset, str):
+            tagset = point_tagset.lower()
+        else:
+            raise Exception('Behavior not defined for {0}'.format(point_tagset))
+        base_class = tagset.split('_')[-1]
+        if base_class not in TOP_CLASS_BASES:
+            top_classes.append(base_class)
+        elif tagset in table:
+            top_classes.append(table[tagset])
+        elif guess_unknown:
+            top_classes.append(_find_top_class(tagset, table_key))
+        else:
+            raise Exception('No super class found for {0}'.format(tagset))
+    return top_classes
+
+
+def get_top_class(point_tagset, *args, **kwargs):
+    return get_top_classes([point_tagset], *args, **kwargs)[0]
 
 def get_point_type(g, point):
     qstr = """
@@ -55,9 +134,9 @@ def get_point_type(g, point):
 class BrickGraph(object):
     def __init__(self,
                  empty=False,
-                 version='1.0.2',
-                 brick_file='brick/Brick_1_0_2.ttl',
-                 brickframe_file='brick/BrickFrame_1_0_2.ttl',
+                 version=DEFAULT_BRICK_VERSION,
+                 brick_file=DEFAULT_BRICK_FILE,
+                 brickframe_file=DEFAULT_BRICKFRAME_FILE,
                  triplestore_type=RDFLIB
                  ):
         self.triplestore_type = triplestore_type
@@ -67,7 +146,7 @@ class BrickGraph(object):
         elif self.triplestore_type == VIRTUOSO:
             self.base_package = virtuoso_wrapper
         self.g = self.base_package.init_graph(empty, brick_file,
-                                              brickframe_file)
+                                              brickframe_file, version)
         self.BRICK = Namespace('https://brickschema.org/schema/{0}/Brick#'
                                .format(self._brick_version))
         self.BF = Namespace('https://brickschema.org/schema/{0}/BrickFrame#'
@@ -81,12 +160,39 @@ class BrickGraph(object):
         prefix bf: <{4}>
         prefix owl: <{5}>
         """.format(str(self.BRICK), RDF, RDFS, self.BASE, str(self.BF), OWL)
+        # srcid -> tagset of the instances added through BrickGraph, and the
+        # revision of the graph it is in sync with.
+        self._instances = {}
+        self._instance_index_revision = self.base_package.get_revision(self.g)
 
     def insert_point(self, name, tagset):
         return self.base_package.insert_point(self.g, name, tagset)
 
     def insert_triple(self, triple):
-        return self.base_package.insert_triple(self.g, triple)
+        return self.insert_triples([triple])
+
+    def insert_triples(self, triples):
+        synced = self._is_instance_index_synced()
+        res = self.base_package.insert_triples(self.g, triples)
+        if synced:
+            self._index_instances(triples)
+        return res
+
+    def _is_instance_index_synced(self):
+        # Catches triples added to or removed from self.g directly.
+        return self.base_package.get_revision(self.g) \
+            == self._instance_index_revision
+
+    def _index_instances(self, triples):
+        for s, p, o in triples:
+            if p == RDF.type and s.startswith(self.BASE):
+                self._instances[s.split('#')[-1]] = o.split('#')[-1]
+        self._instance_index_revision = self.base_package.get_revision(self.g)
+
+    def reindex_instances(self):
+        self._instances = self.base_package.get_instance_tuples(self.g,
+                                                                self.BASE)
+        self._instance_index_revision = self.base_package.get_revision(self.g)
 
     def query_sparql(self, qstr):
         qstr = self.sparql_prefix + qstr
@@ -94,7 +200,7 @@ class BrickGraph(object):
 
     def _try_add_pred_point_result(self, srcid, pred_point):
         triple = self._make_instance_tuple(srcid, pred_point)
-        self.g.add(triple)
+        self.insert_triple(triple)
         return triple
 
     def try_multiple_times(self, f, params):
@@ -122,6 +228,28 @@ class BrickGraph(object):
         })
         return triple
 
+    def _try_add_pred_point_results(self, triples):
+        self.insert_triples(triples)
+        return triples
+
+    def add_pred_point_results(self, srcids, pred_points, confidences=None):
+        """Add the predicted point tagsets of srcids in one batch.
+
+        A failure retries the whole batch. Returns triple -> confidence
+        (None without confidences).
+        """
+        if confidences is None:
+            confidences = [None] * len(srcids)
+        pred_confidences = {}
+        for srcid, pred_point, confidence in zip(srcids, pred_points,
+                                                 confidences):
+            triple = self._make_instance_tuple(srcid, pred_point)
+            pred_confidences[triple] = confidence
+        self.try_multiple_times(self._try_add_pred_point_results, {
+            'triples': list(pred_confidences.keys()),
+        })
+        return pred_confidences
+
     def get_vavs(self):
         qstr = """
         select ?vav where {{
@@ -146,25 +274,14 @@ class BrickGraph(object):
         return (URIRef(self.BASE + srcid), RDF.type, self.BRICK[pred_point])
 
     def get_instance_tuples(self):
-        qstr = self.sparql_prefix + """
-        select ?s ?o where {
-            ?s a ?o.
-            FILTER(STRSTARTS(STR(?s), "%s"))
-        }
-        """ % (self.BASE) # Query selecting any instances with name space BASE.
-        res = self.query_sparql(qstr)
-        return {row['s'].split('#')[-1]: row['o'].split('#')[-1] for row in res}
-        """
-        if self.triplestore_type == 'virtuoso':
-            return {row['s'].split('#')[-1]: row['o'].split('#')[-1] for row in res}
-        elif self.triplestore_type == 'rdflib':
-            # TODO: Need to validate this
-            pdb.set_trace()
-            return {row[0].split('#')[-1]: row[1].split('#')[-1] for row in res}
-        else:
-            raise Exception('triplestoretype incorrectly defined as {0}'
-                            .format(self.triplestore_type))
+        """srcid -> tagset of the instances in the graph.
+
+        It is served from the instance index, which is rebuilt from the
+        graph only if the graph was modified outside BrickGraph.
         """
+        if not self._is_instance_index_synced():
+            self.reindex_instances()
+        return dict(self._instances)
 
     def get_all_tagsets(self):
         qstr = """
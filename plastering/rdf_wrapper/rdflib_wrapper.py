@@ -2,35 +2,114 @@ import pdb
 
 import rdflib
 from rdflib import Graph, RDF, RDFS, OWL, URIRef, Namespace
-from copy import deepcopy
+from rdflib.graph import ReadOnlyGraphAggregate
+from rdflib.paths import Path
 
 from .common import *
 
 
-preloaded_g = None
 schema_g = None
-empty_g = Graph()
+# (brick_file, brickframe_file) -> parsed schema graph
+_schema_graphs = {}
 
 def adder(x, y):
     return x + y
 
-def init_graph(empty=False, brick_file=None, brickframe_file=None):
+def get_schema_graph(brick_file, brickframe_file):
+    """The schema graph of the files, parsed once and shared."""
+    key = (brick_file, brickframe_file)
+    if key not in _schema_graphs:
+        g = Graph()
+        g.parse(brick_file, format='turtle')
+        g.parse(brickframe_file, format='turtle')
+        _schema_graphs[key] = g
+    return _schema_graphs[key]
+
+def init_graph(empty=False, brick_file=None, brickframe_file=None,
+               version=None):
     global schema_g
-    global preloaded_g
     if schema_g == None:
-        schema_g = Graph()
-        schema_g.parse(brick_file, format='turtle')
-        schema_g.parse(brickframe_file, format='turtle')
+        schema_g = get_schema_graph(brick_file, brickframe_file)
 
     if empty:
-        return deepcopy(empty_g)
+        return OverlayGraph(None)
     else:
-        if preloaded_g == None:
-            preloaded_g = Graph()
-            preloaded_g.parse(brick_file, format='turtle')
-            preloaded_g.parse(brickframe_file, format='turtle')
-        return deepcopy(preloaded_g)
-    return g
+        return OverlayGraph(schema_g)
+
+class GraphUnion(ReadOnlyGraphAggregate):
+    """Read-only union of graphs that queries them in place.
+
+    Unlike `g1 + g2`, no triples are copied. A triple found in several
+    graphs is yielded once, as with the set union.
+    """
+    def triples(self, triple):
+        s, p, o = triple
+        if isinstance(p, Path):
+            for s, o in p.eval(self, s, o):
+                yield s, p, o
+            return
+        for i, graph in enumerate(self.graphs):
+            prev_graphs = self.graphs[:i]
+            for t in graph.triples((s, p, o)):
+                if not any(t in prev_graph for prev_graph in prev_graphs):
+                    yield t
+
+    def __len__(self):
+        return sum(1 for _ in self.triples((None, None, None)))
+
+class OverlayGraph(Graph):
+    """Graph over a shared read-only base graph such as the schema.
+
+    Added triples live in the graph's own store, and the base is copied
+    only when one of its triples is removed. base_g may be None.
+    `revision` counts the modifications of the graph.
+    """
+    def __init__(self, base_g):
+        super(OverlayGraph, self).__init__()
+        self.base_g = base_g
+        self.revision = 0
+
+    def _detach(self):
+        base_g = self.base_g
+        self.base_g = None
+        super(OverlayGraph, self).addN((s, p, o, self) for s, p, o in base_g)
+
+    def add(self, triple):
+        self.revision += 1
+        if self.base_g is None or triple not in self.base_g:
+            super(OverlayGraph, self).add(triple)
+        return self
+
+    def addN(self, quads):
+        self.revision += 1
+        super(OverlayGraph, self).addN(
+            (s, p, o, c) for s, p, o, c in quads
+            if self.base_g is None or (s, p, o) not in self.base_g)
+        return self
+
+    def remove(self, triple):
+        self.revision += 1
+        if self.base_g is not None and \
+                next(self.base_g.triples(triple), None) is not None:
+            self._detach()
+        return super(OverlayGraph, self).remove(triple)
+
+    def delta_triples(self, triple):
+        """Triples of the graph's own store, excluding the base."""
+        return super(OverlayGraph, self).triples(triple)
+
+    def triples(self, triple):
+        s, p, o = triple
+        # Paths are evaluated over this graph by Graph.triples itself.
+        for t in super(OverlayGraph, self).triples(triple):
+            yield t
+        if self.base_g is not None and not isinstance(p, Path):
+            for t in self.base_g.triples(triple):
+                yield t
+
+    def __len__(self):
+        base_len = len(self.base_g) if self.base_g is not None else 0
+        return super(OverlayGraph, self).__len__() + base_len
 
 def insert_point(g, name, tagset):
     triple = (URIRef(name), RDF.type, BRICK[tasget])
@@ -39,8 +118,25 @@ def insert_point(g, name, tagset):
 def insert_triple(g, triple):
     g.add(triple)
 
+def insert_triples(g, triples):
+    g.addN((s, p, o, g) for s, p, o in triples)
+
+def get_revision(g):
+    return g.revision
+
+def get_instance_tuples(g, base_ns):
+    """srcid -> tagset of the instances in base_ns, ignoring the schema."""
+    if isinstance(g, OverlayGraph):
+        triples = g.delta_triples((None, RDF.type, None))
+    else:
+        triples = g.triples((None, RDF.type, None))
+    return {s.split('#')[-1]: o.split('#')[-1] for s, _, o in triples
+            if s.startswith(base_ns)}
+
 def query_sparql(g, qstr):
     global schema_g
-    res = (g + schema_g).query(qstr).bindings
+    if g is schema_g or isinstance(g, OverlayGraph) and g.base_g is schema_g:
+        return g.query(qstr).bindings
+    res = GraphUnion([g, schema_g]).query(qstr).bindings
     return res
 
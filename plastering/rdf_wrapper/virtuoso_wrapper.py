@@ -1,28 +1,92 @@
-from copy import deepcopy
+import os
 import pdb
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4 as gen_uuid
 
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
 import rdflib
 from rdflib import RDFS, RDF, OWL, Namespace
 from rdflib.namespace import FOAF
-from SPARQLWrapper import SPARQLWrapper
-from SPARQLWrapper import JSON, SELECT, INSERT, DIGEST, GET, POST
-from rdflib import URIRef, Literal
+from rdflib import URIRef, Literal, BNode
 
 from .common import *
 from ..helpers import chunks
 
 
-def init_graph(empty=False):
-    be = BrickEndpoint('http://localhost:8890/sparql',
-                       BRICK_VERSION,
-                       #load_schema=True #TODO: temporarily force to enable
-                       load_schema=empty,
+SPARQL_URL = os.environ.get('VIRTUOSO_SPARQL_URL',
+                            'http://localhost:8890/sparql')
+SPARQL_USER = os.environ.get('VIRTUOSO_USER', 'dba')
+SPARQL_PASSWORD = os.environ.get('VIRTUOSO_PASSWORD', 'dba')
+# Number of concurrent requests per endpoint, which is also the size of the
+# HTTP connection pool.
+CONCURRENCY = int(os.environ.get('VIRTUOSO_CONCURRENCY', 4))
+REQUEST_TIMEOUT = 60  # sec
+# Number of triples in an INSERT DATA request
+INSERT_CHUNK_SIZE = 300
+BASE = Namespace('http://example.com#')
+
+_sessions = {}  # concurrency -> requests.Session
+_executors = {}  # concurrency -> ThreadPoolExecutor
+_pool_lock = threading.Lock()
+
+
+def get_session(concurrency=CONCURRENCY):
+    """A keep-alive HTTP session shared by the endpoints.
+
+    requests.Session is safe to share as only its connection pool, which
+    blocks beyond `concurrency` connections, is used concurrently.
+    """
+    with _pool_lock:
+        if concurrency not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=concurrency,
+                                  pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[concurrency] = session
+        return _sessions[concurrency]
+
+
+def get_executor(concurrency=CONCURRENCY):
+    with _pool_lock:
+        if concurrency not in _executors:
+            _executors[concurrency] = ThreadPoolExecutor(max_workers=concurrency)
+        return _executors[concurrency]
+
+
+def init_graph(empty=False, brick_file=None, brickframe_file=None,
+               version='1.0.2'):
+    be = BrickEndpoint(SPARQL_URL,
+                       version,
+                       load_schema=not empty,
+                       brick_file=brick_file,
+                       brickframe_file=brickframe_file,
                        )
-
     return be
 
 
+def insert_triple(g, triple):
+    g.add(triple)
+
+def insert_triples(g, triples):
+    g._add_triples(triples)
+
+def get_revision(g):
+    return g.revision
+
+def get_instance_tuples(g, base_ns):
+    qstr = """
+    select ?s ?o where {
+        ?s a ?o.
+        FILTER(STRSTARTS(STR(?s), "%s"))
+    }
+    """ % (base_ns) # Query selecting any instances with name space BASE.
+    res = query_sparql(g, qstr)
+    return {row['s'].split('#')[-1]: row['o'].split('#')[-1] for row in res}
 
 def query_sparql(g, qstr):
     res = g.raw_query(qstr)
@@ -30,56 +94,69 @@ def query_sparql(g, qstr):
 
 
 class BrickEndpoint(object):
+    """A named graph in a Virtuoso server, accessed like an rdflib Graph.
+
+    Requests go through a pooled keep-alive session without any state
+    shared between calls, so an endpoint can be used from several threads.
+    `revision` counts the updates made through the endpoint.
+    """
 
-    def __init__(self, sparql_url, brick_version, base_ns='', load_schema=True):
-        BRICK_VERSION = brick_version
+    def __init__(self, sparql_url, brick_version, base_ns='', load_schema=True,
+                 brick_file=None, brickframe_file=None,
+                 concurrency=CONCURRENCY):
         self.sparql_url = sparql_url
-        self.sparql = SPARQLWrapper(endpoint=self.sparql_url,
-                                    updateEndpoint=self.sparql_url + '-auth')
-        self.sparql.queryType= SELECT
-        self.sparql.setCredentials('dba', 'dba')
-        self.sparql.setHTTPAuth(DIGEST)
-        if not base_ns:
-            base_ns = 'http://example.com/'
+        self.update_url = sparql_url + '-auth'
+        self.auth = HTTPDigestAuth(SPARQL_USER, SPARQL_PASSWORD)
+        self.concurrency = concurrency
+        self.session = get_session(concurrency)
+        self.BRICK = Namespace('https://brickschema.org/schema/{0}/Brick#'
+                               .format(brick_version))
+        self.BF = Namespace('https://brickschema.org/schema/{0}/BrickFrame#'
+                            .format(brick_version))
+        self.BASE = Namespace(base_ns) if base_ns else BASE
+        self.brick_file = brick_file
+        self.brickframe_file = brickframe_file
         self.base_graph = 'urn:' + str(gen_uuid())
-        self.sparql.addDefaultGraph(self.base_graph)
         self.namespaces = {
-            '': BASE,
-            'brick':BRICK,
-            'bf': BF,
+            '': self.BASE,
+            'brick': self.BRICK,
+            'bf': self.BF,
             'rdfs': RDFS,
             'rdf': RDF,
             'owl': OWL,
             'foaf': FOAF
         }
-        sparql_prefix = ''
-        #for prefix, ns in self.namespaces.items():
-        #    ns_n3 = ns.uri.n3()
-        #    sparql_prefix += 'prefix {0}: {1}\n'.format(prefix, ns_n3)
-        #sparql_prefix += '\n'
+        self.sparql_prefix = ''.join('prefix {0}: <{1}>\n'.format(prefix, ns)
+                                     for prefix, ns in self.namespaces.items())
+        self.revision = 0
+        self._revision_lock = threading.Lock()
 
         self._init_brick_constants()
         if load_schema:
             self.load_schema()
 
     def _init_brick_constants(self):
-        self.HAS_LOC = URIRef(BF + 'hasLocation')
-
-    def _get_sparql(self):
-        # If need to optimize accessing sparql object.
-        return self.sparql
+        self.HAS_LOC = URIRef(self.BF + 'hasLocation')
 
     def update(self, qstr):
         return self.query(qstr, is_update=True)
 
+    def _parse_binding(self, binding):
+        if binding['type'] == 'uri':
+            return URIRef(binding['value'])
+        elif binding['type'] == 'bnode':
+            return BNode(binding['value'])
+        else:
+            return Literal(binding['value'],
+                           lang=binding.get('xml:lang'),
+                           datatype=binding.get('datatype'))
+
     def _format_select_res(self, raw_res):
         var_names = raw_res['head']['vars']
-        values = [{var_name: row[var_name]['value']
+        values = [{var_name: self._parse_binding(row[var_name])
                               if var_name in row else None
                    for var_name in var_names}
                   for row in raw_res['results']['bindings']]
-        #var_names = [var_name for var_name in var_names]
-        #return [var_names, values]
         return values
 
     def parse_result(self, res):
@@ -91,25 +168,32 @@ class BrickEndpoint(object):
         return self.query(qstr)
 
     def query(self, qstr, is_update=False):
-        sparql = self._get_sparql()
+        qstr = self.sparql_prefix + qstr
         if is_update:
-            sparql.setMethod(POST)
+            # Every modification goes through here, even a failed one
+            # which may have been applied partially.
+            with self._revision_lock:
+                self.revision += 1
+            resp = self.session.post(self.update_url,
+                                     data={'update': qstr},
+                                     auth=self.auth,
+                                     timeout=REQUEST_TIMEOUT)
         else:
-            sparql.setMethod(GET)
-        sparql.setReturnFormat(JSON)
-        qstr = sparql_prefix + qstr
-        sparql.setHTTPAuth
-        sparql.setQuery(qstr)
-        raw_res = sparql.query().convert()
-        if sparql.queryType == SELECT:
-            res = self._format_select_res(raw_res)
-        elif sparql.queryType == INSERT:
-            res = raw_res # TODO: Error handling here
-        elif sparql.queryType == 'LOAD':
-            res = raw_res # TODO: Error handling here
+            resp = self.session.post(
+                self.sparql_url,
+                data={'query': qstr, 'default-graph-uri': self.base_graph},
+                headers={'Accept': 'application/sparql-results+json'},
+                timeout=REQUEST_TIMEOUT)
+        if resp.status_code >= 400:
+            raise Exception('SPARQL request failed with {0}: {1}'
+                            .format(resp.status_code, resp.text))
+        if is_update:
+            return resp.text
+        raw_res = resp.json()
+        if 'results' in raw_res:
+            return self._format_select_res(raw_res)
         else:
-            res = raw_res
-        return res
+            return raw_res
 
     def _create_insert_query(self, triples):
         q = """
@@ -117,8 +201,7 @@ class BrickEndpoint(object):
                 GRAPH <{0}> {{
             """.format(self.base_graph)
         for triple in triples:
-#            triple_str = ' '.join([term.n3() for term in triple]) + ' .\n'
-            triple_str = ' '.join(['<{0}>'.format(str(term)) for term in triple]) + ' .\n'
+            triple_str = ' '.join([term.n3() for term in triple]) + ' .\n'
             q += triple_str
         q += """}
             }
@@ -159,12 +242,12 @@ class BrickEndpoint(object):
                 ns = self.namespaces[ns]
                 node = ns[id_]
             else:
-                if term.isdigit():
+                if self._is_bool(term):
+                    term = self._str2bool(term)
+                elif term.isdigit():
                     term = int(term)
                 elif self._is_float(term):
                     term = float(term)
-                if self._is_bool(term):
-                    term = _str2bool(term)
                 node = Literal(term)
         else:
             node = Literal(term)
@@ -189,25 +272,45 @@ class BrickEndpoint(object):
         self._add_triples(triples)
 
     def _add_triples(self, triples):
-        q = self._create_insert_query(triples)
-        res = self.update(q)
+        """Insert the triples with up to `concurrency` INSERT DATA requests
+        in flight."""
+        queries = [self._create_insert_query(chunk)
+                   for chunk in chunks(list(triples), INSERT_CHUNK_SIZE)]
+        if len(queries) <= 1 or self.concurrency <= 1:
+            for q in queries:
+                self.update(q)
+        else:
+            # Consuming the results raises the first failure.
+            list(get_executor(self.concurrency).map(self.update, queries))
+
+    def remove(self, triple):
+        pattern = ' '.join(term.n3() if term is not None else '?' + var
+                           for term, var in zip(triple, ['s', 'p', 'o']))
+        q = """
+        DELETE WHERE {{
+            GRAPH <{0}> {{ {1} . }}
+        }}
+        """.format(self.base_graph, pattern)
+        self.update(q)
 
     def add_brick_instance(self, entity_name, tagset):
-        entity = URIRef(BASE + entity_name)
-        tagset = URIRef(BRICK + tagset)
+        entity = URIRef(self.BASE + entity_name)
+        tagset = URIRef(self.BRICK + tagset)
         triples = [(entity, RDF.type, tagset)]
         self._add_triples(triples)
         return str(entity)
 
     def load_ttlfile(self, filepath):
+        if '://' not in filepath:
+            filepath = 'file://' + os.path.abspath(filepath)
         q = """
-        load <file://{0}> into <{1}>
+        load <{0}> into graph <{1}>
         """.format(filepath, self.base_graph)
         res = self.update(q)
 
     def load_schema(self):
-        self.load_ttlfile(BRICK_FILE)
-        self.load_ttlfile(BF_FILE)
+        self.load_ttlfile(self.brick_file)
+        self.load_ttlfile(self.brickframe_file)
 
     def parse(self, filepath, format=None):
         self.load_ttlfile(filepath)
@@ -218,30 +321,44 @@ class BrickEndpoint(object):
         ?s ?p ?o .
         FILTER(STRSTARTS(STR(?s), "%s"))
         }
-        """ % (BASE)
+        """ % (self.BASE)
         res = self.raw_query(qstr)
         return res
 
-    def __add__(self, other):
-        assert isinstance(other, BrickEndpoint)
+    def __len__(self):
         qstr = """
-        select ?s ?p ?o where{
+        select (count(*) as ?cnt) where {
         ?s ?p ?o .
-        FILTER(STRSTARTS(STR(?s), "%s"))
         }
-        """ % (BASE)
-        res = other.raw_query(qstr)
-        triples = [(URIRef(row['s']), URIRef(row['p']), URIRef(row['o'])) for row in res]
-        triple_chunks = chunks(triples, 300)
-        for chunk in triple_chunks:
-            self._add_triples(chunk)
+        """
+        return int(self.raw_query(qstr)[0]['cnt'])
+
+    def __add__(self, other):
+        """Copy other's instance triples into this graph inside the server."""
+        assert isinstance(other, BrickEndpoint)
+        if other.sparql_url != self.sparql_url:
+            raise Exception('Cannot merge graphs of different servers: {0}, {1}'
+                            .format(self.sparql_url, other.sparql_url))
+        q = """
+        INSERT {
+            GRAPH <%s> { ?s ?p ?o . }
+        }
+        WHERE {
+            GRAPH <%s> {
+                ?s ?p ?o .
+                FILTER(STRSTARTS(STR(?s), "%s"))
+            }
+        }
+        """ % (self.base_graph, other.base_graph, self.BASE)
+        self.update(q)
         return self
 
 
 
 if __name__ == '__main__':
-    endpoint = BrickEndpoint('http://localhost:8890/sparql', '1.0.3')
-    endpoint.load_schema()
+    endpoint = BrickEndpoint('http://localhost:8890/sparql', '1.0.2',
+                             brick_file='brick/Brick_1_0_2.ttl',
+                             brickframe_file='brick/BrickFrame_1_0_2.ttl')
     test_qstr = """
         select ?s where {
         ?s rdfs:subClassOf+ brick:Temperature_Sensor .
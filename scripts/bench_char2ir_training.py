@@ -0,0 +1,131 @@
+import sys, os
+import time
+import random
+import argparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from plastering.inferencers.scrabble.char2ir import Char2Ir
+
+'''
+Compares Char2Ir's full and incremental CRF training per active learning
+round on a synthesized building.
+e.g.,: python scripts/bench_char2ir_training.py -n 5000 -r 20 -inc 10
+Trained models are not stored in MongoDB.
+'''
+
+EQUIPS = {
+    'room': ['RM', 'ROOM', 'R'],
+    'ahu': ['AH', 'AHU'],
+    'vav': ['VAV', 'VMA'],
+    'fan_coil_unit': ['FCU', 'FC'],
+    'chiller': ['CH', 'CHLR'],
+}
+POINTS = {
+    'zone_temperature_sensor': ['ZNT', 'ZN-T', 'ZONE-TEMP'],
+    'supply_air_temperature_sensor': ['SAT', 'SA-T', 'SUP-AIR-TEMP'],
+    'return_air_temperature_sensor': ['RAT', 'RA-T'],
+    'occupancy_sensor': ['OCC', 'OCC-S'],
+    'co2_sensor': ['CO2', 'CO2-S'],
+    'damper_position_sensor': ['DMPR-POS', 'DPR'],
+    'cooling_setpoint': ['CLGSP', 'CLG-SP', 'CSP'],
+    'heating_setpoint': ['HTGSP', 'HTG-SP', 'HSP'],
+    'fan_status': ['FAN-S', 'SF-S'],
+    'valve_command': ['VLV-C', 'VLV'],
+}
+SEPARATORS = ['-', '.', '_', ' ', ':']
+
+
+def add_word(sentence, labels, word, label):
+    sentence += list(word.lower())
+    labels += ['B_' + label] + ['I_' + label] * (len(word) - 1)
+
+
+def gen_point(r):
+    sentence = []
+    labels = []
+    for _ in range(r.choice([1, 2])):
+        equip, words = r.choice(list(EQUIPS.items()))
+        add_word(sentence, labels, r.choice(words), equip)
+        if r.random() < 0.5:
+            sentence.append(r.choice(SEPARATORS))
+            labels.append('O')
+        add_word(sentence, labels, str(r.randrange(1, 999)), 'leftidentifier')
+        sentence.append(r.choice(SEPARATORS))
+        labels.append('O')
+    point, words = r.choice(list(POINTS.items()))
+    add_word(sentence, labels, r.choice(words), point)
+    return sentence, labels
+
+
+def gen_building(n, seed):
+    r = random.Random(seed)
+    sentence_dict = {}
+    label_dict = {}
+    for i in range(n):
+        sentence, labels = gen_point(r)
+        srcid = 'bench_{0}'.format(i)
+        sentence_dict[srcid] = {'VendorGivenName': sentence}
+        label_dict[srcid] = {'VendorGivenName': labels}
+    return sentence_dict, label_dict
+
+
+def run(sentence_dict, label_dict, config, args):
+    random.seed(args.seed)
+    building = 'bench_building'
+    char2ir = Char2Ir(building,
+                      list(sentence_dict.keys()),
+                      {building: label_dict},
+                      {building: sentence_dict},
+                      [],
+                      [args.seed_num],
+                      [],
+                      config)
+    char2ir.update_model([])
+    train_time = 0
+    accuracies = []
+    for i in range(args.round_num):
+        new_srcids = char2ir.select_informative_samples(args.inc_num)
+        t0 = time.time()
+        char2ir.update_model(new_srcids)
+        t1 = time.time()
+        res = char2ir.evaluate(char2ir.predict())
+        train_time += t1 - t0
+        accuracies.append(res['accuracy'])
+        print('round {0}: # of learning srcids: {1}, training: {2:.3f} sec, '
+              'accuracy: {3:.4f}, f1: {4:.4f}'
+              .format(i, len(set(char2ir.learning_srcids)), t1 - t0,
+                      res['accuracy'], res['f1']))
+    print('total training: {0:.3f} sec, mean accuracy: {1:.4f}'
+          .format(train_time, sum(accuracies) / len(accuracies)))
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-n', type=int, dest='point_num', default=5000)
+argparser.add_argument('-r', type=int, dest='round_num', default=20)
+argparser.add_argument('-seed_num', type=int, dest='seed_num', default=10)
+argparser.add_argument('-inc', type=int, dest='inc_num', default=10)
+argparser.add_argument('-replay', type=int, dest='replay_num', default=200)
+argparser.add_argument('-iter', type=int, dest='inc_iterations', default=50)
+argparser.add_argument('-full', type=int, dest='full_retrain_interval', default=5)
+argparser.add_argument('-s', type=int, dest='seed', default=0)
+args = argparser.parse_args()
+
+os.makedirs('temp', exist_ok=True)
+sentence_dict, label_dict = gen_building(args.point_num, args.seed)
+base_config = {
+    'available_metadata_types': ['VendorGivenName'],
+    'model_persistence': 'on_demand',
+}
+configs = {
+    'full': base_config,
+    'incremental': dict(base_config,
+                        crf_incremental=True,
+                        crf_replay_num=args.replay_num,
+                        crf_replay_seed=args.seed,
+                        crf_inc_iterations=args.inc_iterations,
+                        crf_full_retrain_interval=args.full_retrain_interval),
+}
+for name, config in configs.items():
+    print('== {0} =='.format(name))
+    run(sentence_dict, label_dict, config, args)
@@ -0,0 +1,50 @@
+import sys, os
+import time
+import resource
+import argparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from plastering.rdf_wrapper import BrickGraph
+
+'''
+Measures the construction time and the memory of the graphs an inferencer
+creates: template_g, prior_g, schema_g and pred_g, plus one pred_g per predict.
+e.g.,: python scripts/bench_graph_init.py -i 5 -p 10
+Memory is the peak RSS of the process, so run it once per setting.
+'''
+
+
+def get_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def new_graph(empty):
+    return BrickGraph(empty)
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-i', type=int, dest='inferencer_num', default=5)
+argparser.add_argument('-p', type=int, dest='predict_num', default=10)
+args = argparser.parse_args()
+
+t0 = time.time()
+new_graph(True)  # Parse the schema once.
+t1 = time.time()
+rss0 = get_rss_mb()
+print('schema loading: {0:.3f} sec, RSS: {1:.1f} MB'.format(t1 - t0, rss0))
+
+graphs = []
+for _ in range(args.inferencer_num):
+    t0 = time.time()
+    inferencer_graphs = [new_graph(True), new_graph(True), new_graph(False),
+                         new_graph(True)]
+    t1 = time.time()
+    for _ in range(args.predict_num):
+        inferencer_graphs.append(new_graph(True))
+    t2 = time.time()
+    graphs.append(inferencer_graphs)
+    print('inferencer init: {0:.3f} sec, {1} predicts: {2:.3f} sec, '
+          'RSS: {3:.1f} MB'.format(t1 - t0, args.predict_num, t2 - t1,
+                                   get_rss_mb()))
+print('RSS increase: {0:.1f} MB'.format(get_rss_mb() - rss0))
@@ -0,0 +1,89 @@
+import sys, os
+import time
+import random
+import argparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from plastering.metadata_interface import *
+
+'''
+Measures the ingestion rate of a synthesized building into the metadata store
+with per-point upserts and with the bulk API.
+e.g.,: python scripts/bench_metadata_loader.py -n 50000 -batch 1000
+The benchmark building is removed before and after each run.
+'''
+
+POINT_SUFFIXES = ['ZNT', 'ZN-T', 'DMPR-POS', 'SAT', 'RAT', 'SUPFLOW', 'CLGSP',
+                  'HTGSP', 'OCC', 'CO2', 'RH', 'FAN-S', 'FAN-C', 'VLV-C']
+ROOM_PREFIXES = ['RM', 'AH', 'VAV', 'CRAC', 'FCU']
+pgid = 'master'
+
+
+def gen_points(n):
+    metadata_dict = {}
+    labels_dict = {}
+    for i in range(n):
+        name = '{0}-{1}.{2}'.format(random.choice(ROOM_PREFIXES),
+                                    random.randrange(100, 999),
+                                    random.choice(POINT_SUFFIXES))
+        srcid = 'bench_{0}'.format(i)
+        metadata_dict[srcid] = {'VendorGivenName': name}
+        labels_dict[srcid] = {'point_tagset': 'zone_temperature_sensor',
+                              'tagsets': ['zone_temperature_sensor', 'room']}
+    return metadata_dict, labels_dict
+
+
+def clear(building):
+    RawMetadata.objects(building=building).delete()
+    LabeledMetadata.objects(building=building).delete()
+
+
+def load_per_point(building, metadata_dict, labels_dict, batch_size):
+    for srcid, metadata in metadata_dict.items():
+        raw_obj = RawMetadata.objects(srcid=srcid, building=building)\
+            .upsert_one(srcid=srcid, building=building)
+        raw_obj.metadata = metadata
+        raw_obj.save()
+    for srcid, labels in labels_dict.items():
+        labeled_obj = LabeledMetadata.objects(
+            srcid=srcid, building=building, pgid=pgid)\
+            .upsert_one(srcid=srcid, building=building, pgid=pgid)
+        for k, v in labels.items():
+            labeled_obj[k] = v
+        labeled_obj.save()
+
+
+def load_bulk(building, metadata_dict, labels_dict, batch_size):
+    bulk_insert_rawmetadata(building, metadata_dict, batch_size)
+    bulk_insert_groundtruth(building, pgid, labels_dict, batch_size)
+
+
+LOADERS = {
+    'per_point': load_per_point,
+    'bulk': load_bulk,
+}
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-n', type=int, dest='point_num', default=50000)
+argparser.add_argument('-batch', type=int, dest='batch_size', default=1000)
+argparser.add_argument('-l', type=str, dest='loaders', default='per_point,bulk')
+argparser.add_argument('-b', type=str, dest='building', default='bench_loader')
+argparser.add_argument('-s', type=int, dest='seed', default=0)
+args = argparser.parse_args()
+
+random.seed(args.seed)
+metadata_dict, labels_dict = gen_points(args.point_num)
+print('points: {0}, batch size: {1}'.format(args.point_num, args.batch_size))
+
+for loader in args.loaders.split(','):
+    clear(args.building)
+    t0 = time.time()
+    LOADERS[loader](args.building, metadata_dict, labels_dict, args.batch_size)
+    t1 = time.time()
+    assert RawMetadata.objects(building=args.building).count() == args.point_num
+    assert LabeledMetadata.objects(building=args.building, pgid=pgid).count() \
+        == args.point_num
+    print('{0}: {1:.3f} sec, {2:.0f} points/sec'
+          .format(loader, t1 - t0, args.point_num / (t1 - t0)))
+clear(args.building)
@@ -0,0 +1,72 @@
+import sys, os
+import time
+import random
+import argparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from rdflib import URIRef
+
+from plastering.rdf_wrapper import BrickGraph
+from plastering.rdf_wrapper import rdflib_wrapper
+
+'''
+Compares BrickGraph queries over the copied union of the prediction graph and
+the Brick schema (`g + schema_g`) and over the in-place union view.
+e.g.,: python scripts/bench_rdf_query.py -n 300 -r 3
+Only the rdflib backend is measured.
+'''
+
+POINT_TAGSETS = ['zone_temperature_sensor', 'supply_air_flow_sensor',
+                 'damper_position_command', 'occupancy_sensor',
+                 'cooling_temperature_setpoint', 'co2_sensor']
+
+
+def copy_union_query_sparql(g, qstr):
+    return (g + rdflib_wrapper.schema_g).query(qstr).bindings
+
+
+def gen_graph(n, empty):
+    brick_g = BrickGraph(empty=empty)
+    vav_num = max(n // len(POINT_TAGSETS), 1)
+    for i in range(n):
+        srcid = 'point_{0}'.format(i)
+        vav = 'vav_{0}'.format(random.randrange(vav_num))
+        brick_g.add_pred_point_result(srcid, random.choice(POINT_TAGSETS))
+        brick_g.add_pred_point_result(vav, 'vav')
+        brick_g.g.add((URIRef(brick_g.BASE + srcid), brick_g.BF.isPointOf,
+                       URIRef(brick_g.BASE + vav)))
+    return brick_g
+
+
+def run_queries(brick_g):
+    vavs = sorted(brick_g.get_vavs())
+    vav_points = {vav: sorted(brick_g.get_vav_points(vav)) for vav in vavs}
+    instances = brick_g.get_instance_tuples()
+    return vavs, vav_points, instances
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-n', type=int, dest='point_num', default=300)
+argparser.add_argument('-r', type=int, dest='repeat_num', default=3)
+argparser.add_argument('-s', type=int, dest='seed', default=0)
+args = argparser.parse_args()
+
+random.seed(args.seed)
+union_query_sparql = rdflib_wrapper.query_sparql
+for empty in [True, False]:
+    brick_g = gen_graph(args.point_num, empty)
+    print('== {0} graph: {1} triples =='
+          .format('empty' if empty else 'preloaded', len(brick_g.g)))
+    results = {}
+    for name, query_sparql in [('copy', copy_union_query_sparql),
+                               ('union view', union_query_sparql)]:
+        rdflib_wrapper.query_sparql = query_sparql
+        t0 = time.time()
+        for _ in range(args.repeat_num):
+            results[name] = run_queries(brick_g)
+        t1 = time.time()
+        print('{0}: {1:.3f} sec per round ({2} VAVs)'
+              .format(name, (t1 - t0) / args.repeat_num, len(results[name][0])))
+    rdflib_wrapper.query_sparql = union_query_sparql
+    assert results['copy'] == results['union view']
@@ -0,0 +1,66 @@
+import sys, os
+import time
+import random
+import argparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from sklearn.metrics import adjusted_rand_score
+
+from plastering.inferencers.zodiac import CLUSTERING_BACKENDS
+from plastering.inferencers.zodiac import get_vectorizer
+
+'''
+Compares Zodiac's clustering backends on a synthesized building.
+e.g.,: python scripts/bench_zodiac_clustering.py -n 5000 -b linkage,dedup
+
+Partitions are identical when merge distances have no ties. With ties,
+complete linkage is not unique and the backends may break them differently,
+which the adjusted Rand index below shows.
+'''
+
+POINT_SUFFIXES = ['ZNT', 'ZN-T', 'DMPR-POS', 'SAT', 'RAT', 'SUPFLOW', 'CLGSP',
+                  'HTGSP', 'OCC', 'CO2', 'RH', 'FAN-S', 'FAN-C', 'VLV-C']
+ROOM_PREFIXES = ['RM', 'AH', 'VAV', 'CRAC', 'FCU']
+
+
+def gen_names(n):
+    names = []
+    for i in range(n):
+        prefix = random.choice(ROOM_PREFIXES)
+        suffix = random.choice(POINT_SUFFIXES)
+        names.append('{0}-{1}.{2}'.format(prefix, random.randrange(100, 999), suffix))
+    return names
+
+
+def same_partition(b1, b2):
+    pairs = set(zip(b1, b2))
+    return len(pairs) == len(set(b1)) == len(set(b2))
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-n', type=int, dest='point_num', default=5000)
+argparser.add_argument('-b', type=str, dest='backends', default='linkage,dedup')
+argparser.add_argument('-s', type=int, dest='seed', default=0)
+args = argparser.parse_args()
+
+random.seed(args.seed)
+names = gen_names(args.point_num)
+bow = get_vectorizer('VendorGivenName').fit_transform(names).tocsr()
+print('points: {0}, features: {1}'.format(*bow.shape))
+
+results = {}
+for backend in args.backends.split(','):
+    t0 = time.time()
+    b, thresh = CLUSTERING_BACKENDS[backend](bow)
+    t1 = time.time()
+    results[backend] = b
+    print('{0}: {1:.3f} sec, threshold: {2}, # of clusters: {3}'
+          .format(backend, t1 - t0, thresh, len(set(b))))
+
+backends = list(results.keys())
+for backend in backends[1:]:
+    print('{0} vs {1}: same partition: {2}, adjusted rand index: {3:.3f}'
+          .format(backends[0], backend,
+                  same_partition(results[backends[0]], results[backend]),
+                  adjusted_rand_score(results[backends[0]], results[backend])))
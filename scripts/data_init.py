@@ -10,7 +10,7 @@ from plastering.metadata_interface import *
 from plastering.common import *
 from plastering.helper import load_uva_building, load_ucb_building
 from plastering.helper import extract_raw_ucb_labels
-from plastering.rdf_wrapper import get_top_class
+from plastering.rdf_wrapper import get_top_classes
 from jasonhelper import argparser
 
 UCB_BUILDINGS = ['sdh', 'soda', 'ibm']
@@ -18,67 +18,60 @@ CMU_BUILDINGS = ['ghc']
 
 pgid = 'master'
 
-def parse_ucsd_rawmetadata(building):
+def parse_ucsd_rawmetadata(building, batch_size=1000):
     rawdf = pd.read_csv('rawdata/metadata/{0}_rawmetadata.csv'\
                             .format(building), index_col='SourceIdentifier')
+    metadata_dict = {}
     for srcid, row in rawdf.iterrows():
-        point = RawMetadata.objects(srcid=srcid, building=building)\
-                           .upsert_one(srcid=srcid, building=building)
+        metadata = {}
         for k, v in row.items():
             if not isinstance(v, str):
                 if np.isnan(v):
                     v = ''
-            point.metadata[k] = v
-        point.save()
+            metadata[k] = v
+        metadata_dict[srcid] = metadata
+    bulk_insert_rawmetadata(building, metadata_dict, batch_size, merge=True)
 
 print('Finished adding raw metadata')
 
 # add labeled metadata
 
-def parse_fullparsing(building, write_rawmetadata=False):
+def parse_fullparsing(building, write_rawmetadata=False, batch_size=1000):
     with open('groundtruth/{0}_full_parsing.json'.format(building), 'r') as fp:
         fullparsings = json.load(fp)
+    labels_dict = {}
+    metadata_dict = {}
     for srcid, fullparsing in fullparsings.items():
         if building in UCB_BUILDINGS + CMU_BUILDINGS:
             fullparsing = {
                 'VendorGivenName': fullparsing
             }
-        point = LabeledMetadata.objects(srcid=srcid,
-                                        building=building,
-                                        pgid=pgid,
-                                        ).upsert_one(srcid=srcid,
-                                                     building=building,
-                                                     pgid=pgid,
-                                                     )
-        point.fullparsing = fullparsing
-        try:
-            point.save()
-        except:
-            pdb.set_trace()
+        labels_dict[srcid] = {'fullparsing': fullparsing}
         if write_rawmetadata:
-            rawpoint = RawMetadata.objects(srcid=srcid, building=building)\
-                .upsert_one(srcid=srcid, building=building)
             sentence = ''.join([row[0] for row in fullparsing['VendorGivenName']])
-            rawpoint.metadata = {
+            metadata_dict[srcid] = {
                 'VendorGivenName': sentence
             }
-            rawpoint.save()
+    bulk_insert_groundtruth(building, pgid, labels_dict, batch_size)
+    if write_rawmetadata:
+        bulk_insert_rawmetadata(building, metadata_dict, batch_size)
 
     print('Finished adding full parsing')
 
 # add tagsets
-def parse_tagsets(building):
+def parse_tagsets(building, batch_size=1000):
     with open('groundtruth/{0}_tagsets.json'.format(building), 'r') as fp:
         true_tagsets = json.load(fp)
+    labels_dict = {}
     for srcid, tagsets in true_tagsets.items():
-        point = LabeledMetadata.objects(srcid=srcid, building=building, pgid=pgid)\
-                               .upsert_one(srcid=srcid, building=building, pgid=pgid)
-        point.tagsets = tagsets
-        point_tagset = sel_point_tagset(tagsets)
+        point_tagset = select_point_tagset(tagsets, srcid)
         if not point_tagset:
             point_tagset = 'none'
-        point.point_tagset = point_tagset
-        point.save()
+        labels_dict[srcid] = {
+            'tagsets': tagsets,
+            'point_tagset': point_tagset,
+        }
+    bulk_insert_groundtruth(building, pgid, labels_dict, batch_size)
 
 def remove_invalid_srcids(building):
     with open('config/invalid_srcids.json', 'r') as fp:
@@ -99,13 +92,18 @@ if __name__ == '__main__':
                            type='bool',
                            dest='topclass_flag',
                            default=False)
+    argparser.add_argument('-batch',
+                           type=int,
+                           dest='batch_size',
+                           default=1000)
     # add raw metadata
     args = argparser.parse_args()
     building = args.building
+    batch_size = args.batch_size
 
 
     if building == 'uva_cse':
-        load_uva_building(building)
+        load_uva_building(building, batch_size=batch_size)
         print('UVA CSE Done')
         sys.exit()
     elif building in UCB_BUILDINGS:
@@ -116,21 +114,22 @@ if __name__ == '__main__':
             'sdh': basedir + 'SDH-GROUND-TRUTH',
             'ibm': basedir + 'IBM-GROUND-TRUTH',
         }
-        load_ucb_building(building, filenames[building], pgid=pgid)
+        load_ucb_building(building, filenames[building], pgid=pgid,
+                          batch_size=batch_size)
         #parse_tagsets(building)
-        parse_fullparsing(building)
+        parse_fullparsing(building, batch_size=batch_size)
     elif building in CMU_BUILDINGS:
-        parse_tagsets(building)
-        parse_fullparsing(building, write_rawmetadata=True)
+        parse_tagsets(building, batch_size)
+        parse_fullparsing(building, write_rawmetadata=True, batch_size=batch_size)
     else:
-        parse_ucsd_rawmetadata(building)
-        parse_tagsets(building)
-        parse_fullparsing(building)
+        parse_ucsd_rawmetadata(building, batch_size)
+        parse_tagsets(building, batch_size)
+        parse_fullparsing(building, batch_size=batch_size)
     remove_invalid_srcids(building)
 
     if args.topclass_flag:
-        for obj in LabeledMetadata.objects(building=building):
-            point_tagset = obj.point_tagset
-            topclass_tagset = get_top_class(point_tagset)
+        objs = list(LabeledMetadata.objects(building=building))
+        topclass_tagsets = get_top_classes([obj.point_tagset for obj in objs])
+        for obj, topclass_tagset in zip(objs, topclass_tagsets):
             obj.point_tagset = topclass_tagset
             obj.save()
@@ -0,0 +1,24 @@
+import pytest
+
+'''
+Fixtures for running the test scripts under pytest. The scripts also run
+on their own, e.g., python test/test_virtuoso_endpoint.py
+'''
+
+
+@pytest.fixture(scope='module')
+def server_url(request):
+    # An in-process SPARQL server from the module's start_server().
+    server, url = request.module.start_server()
+    yield server, url
+    server.shutdown()
+
+
+@pytest.fixture(scope='module')
+def server(server_url):
+    return server_url[0]
+
+
+@pytest.fixture(scope='module')
+def url(server_url):
+    return server_url[1]
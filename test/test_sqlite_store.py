@@ -0,0 +1,78 @@
+import sys, os
+import tempfile
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+os.environ['METADATA_STORE_TYPE'] = 'sqlite'
+# The store never touches the default file, also when run by pytest.
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ['METADATA_SQLITE_FILE'] = os.path.join(tmp_dir.name,
+                                                  'metadata.sqlite3')
+
+from plastering.metadata_store import sqlite_store
+from plastering.metadata_store.sqlite_store import RawMetadata
+
+'''
+Tests the QuerySet of the SQLite metadata store on a temporary file.
+e.g.,: python test/test_sqlite_store.py (or pytest test/test_sqlite_store.py)
+'''
+
+
+def setup_module(module=None):
+    # The store may have been imported with another file before.
+    sqlite_store.DB_FILE = os.environ['METADATA_SQLITE_FILE']
+    sqlite_store._conn = None
+    insert_points(5)
+
+
+def teardown_module(module=None):
+    sqlite_store.get_connection().close()
+    sqlite_store._conn = None
+
+
+def insert_points(n):
+    sqlite_store.bulk_upsert(
+        RawMetadata,
+        [{'srcid': 'point_{0}'.format(i), 'building': 'bldg',
+          'metadata': {'VendorGivenName': 'RM-{0}.ZNT'.format(i)}}
+         for i in range(n)],
+        ['srcid', 'building'])
+
+
+def test_slicing():
+    qs = RawMetadata.objects(building='bldg')
+    srcids = [doc.srcid for doc in qs[0:]]
+    assert srcids == ['point_{0}'.format(i) for i in range(5)]
+    assert [doc.srcid for doc in qs[2:]] == srcids[2:]
+    assert [doc.srcid for doc in qs[:2]] == srcids[:2]
+    assert [doc.srcid for doc in qs[1:3]] == srcids[1:3]
+    assert [doc.srcid for doc in qs[3:1]] == []
+    assert [doc.srcid for doc in qs[7:]] == []
+    assert qs[4].srcid == srcids[4]
+
+
+def test_upsert_merge():
+    sqlite_store.bulk_upsert(
+        RawMetadata,
+        [{'srcid': 'point_0', 'building': 'bldg', 'metadata.BACnetName': 'ZNT',
+          'metadata.BACnetUnit': 64},
+         {'srcid': 'point_9', 'building': 'bldg', 'metadata.BACnetName': 'SAT'}],
+        ['srcid', 'building'])
+    assert RawMetadata.objects(srcid='point_0').first().metadata == {
+        'VendorGivenName': 'RM-0.ZNT', 'BACnetName': 'ZNT', 'BACnetUnit': 64}
+    assert RawMetadata.objects(srcid='point_9').first().metadata == {
+        'BACnetName': 'SAT'}
+    sqlite_store.bulk_upsert(
+        RawMetadata,
+        [{'srcid': 'point_0', 'building': 'bldg', 'metadata': {'BACnetName': 'Z'}}],
+        ['srcid', 'building'])
+    assert RawMetadata.objects(srcid='point_0').first().metadata == {
+        'BACnetName': 'Z'}
+
+
+if __name__ == '__main__':
+    setup_module()
+    tests = [test_slicing, test_upsert_merge]
+    for test in tests:
+        test()
+        print('{0}: OK'.format(test.__name__))
+    teardown_module()
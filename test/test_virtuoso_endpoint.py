@@ -0,0 +1,171 @@
+import sys, os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, dir_path + '/..')
+
+from rdflib import Dataset, URIRef, Literal, RDF
+
+from plastering.rdf_wrapper import BrickGraph, VIRTUOSO
+from plastering.rdf_wrapper import virtuoso_wrapper
+from plastering.rdf_wrapper.virtuoso_wrapper import BrickEndpoint
+
+'''
+Tests BrickEndpoint against an in-process SPARQL server backed by rdflib,
+standing in for Virtuoso. No Virtuoso or network access is needed.
+e.g.,: python test/test_virtuoso_endpoint.py (or pytest, see conftest.py)
+'''
+
+
+class SparqlHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        super(SparqlHandler, self).setup()
+        with self.server.lock:
+            self.server.connection_num += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self._handle(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def _handle(self, params):
+        try:
+            with self.server.lock:
+                if 'update' in params:
+                    self.server.request_nums['update'] += 1
+                    self.server.dataset.update(params['update'][0])
+                    body = b'{}'
+                else:
+                    self.server.request_nums['query'] += 1
+                    graph_uris = params.get('default-graph-uri')
+                    if graph_uris:
+                        g = self.server.dataset.graph(URIRef(graph_uris[0]))
+                    else:
+                        g = self.server.dataset
+                    body = g.query(params['query'][0]).serialize(format='json')
+            status = 200
+        except Exception as e:
+            status = 400
+            body = str(e).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SparqlHandler)
+    server.daemon_threads = True
+    server.dataset = Dataset()
+    server.lock = threading.Lock()
+    server.connection_num = 0
+    server.request_nums = Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}/sparql'.format(server.server_port)
+
+
+def make_triples(be, n, prefix='point'):
+    return [(URIRef(be.BASE + '{0}_{1}'.format(prefix, i)), RDF.type,
+             be.BRICK['Zone_Temperature_Sensor']) for i in range(n)]
+
+
+def test_batched_insert(server, url):
+    be = BrickEndpoint(url, '1.0.2', load_schema=False, concurrency=4)
+    triples = make_triples(be, 1000)
+    before = server.request_nums['update']
+    be.add_triples(triples + [(triples[0][0], be.BF.hasName, Literal('RM-101 ZNT'))])
+    # 1001 triples in INSERT_CHUNK_SIZE chunks
+    assert server.request_nums['update'] - before == 4
+    assert len(be) == 1001
+    res = be.query('select ?name where { ?s bf:hasName ?name . }')
+    assert res == [{'name': Literal('RM-101 ZNT')}]
+    be.remove((triples[0][0], None, None))
+    assert len(be) == 999
+
+
+def test_concurrent_queries(server, url):
+    be = BrickEndpoint(url, '1.0.2', load_schema=False, concurrency=4)
+    be.add_triples(make_triples(be, 50))
+    errors = []
+
+    def query_points(i):
+        try:
+            res = be.query("""
+            select ?s where {{ ?s a brick:Zone_Temperature_Sensor .
+            FILTER(STR(?s) = "{0}point_{1}") }}
+            """.format(be.BASE, i))
+            assert res == [{'s': URIRef(be.BASE + 'point_{0}'.format(i))}]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query_points, args=(i % 50,))
+               for i in range(200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def test_server_side_merge(server, url):
+    be1 = BrickEndpoint(url, '1.0.2', load_schema=False)
+    be2 = BrickEndpoint(url, '1.0.2', load_schema=False)
+    be1.add_triples(make_triples(be1, 10, 'a'))
+    be2.add_triples(make_triples(be2, 700, 'b'))
+    nums = Counter(server.request_nums)
+    merged = be1 + be2
+    assert merged is be1
+    assert server.request_nums['update'] - nums['update'] == 1
+    assert server.request_nums['query'] == nums['query']
+    assert len(be1) == 710 and len(be2) == 700
+
+
+def test_brick_graph(server, url):
+    sparql_url = virtuoso_wrapper.SPARQL_URL
+    virtuoso_wrapper.SPARQL_URL = url
+    try:
+        brick_g = BrickGraph(empty=False, triplestore_type=VIRTUOSO)
+    finally:
+        virtuoso_wrapper.SPARQL_URL = sparql_url
+    assert len(brick_g.g) > 0  # The schema is loaded in the server.
+    brick_g.add_pred_point_results(['vav_1', 'znt_1'],
+                                   ['VAV', 'Zone_Temperature_Sensor'],
+                                   [0.9, 0.8])
+    brick_g.g.add((URIRef(brick_g.BASE + 'znt_1'), brick_g.BF.isPointOf,
+                   URIRef(brick_g.BASE + 'vav_1')))
+    assert brick_g.get_instance_tuples() == {
+        'vav_1': 'VAV',
+        'znt_1': 'Zone_Temperature_Sensor',
+    }
+    assert brick_g.get_vav_points(URIRef(brick_g.BASE + 'vav_1')) == \
+        [URIRef(brick_g.BASE + 'znt_1')]
+    # Direct modifications of the endpoint invalidate the instance index.
+    ahu = URIRef(brick_g.BASE + 'ahu_1')
+    brick_g.g.add((ahu, RDF.type, brick_g.BRICK['AHU']))
+    assert brick_g.get_instance_tuples()['ahu_1'] == 'AHU'
+    brick_g.g.remove((ahu, None, None))
+    assert 'ahu_1' not in brick_g.get_instance_tuples()
+
+
+if __name__ == '__main__':
+    server, url = start_server()
+    tests = [test_batched_insert, test_concurrent_queries,
+             test_server_side_merge, test_brick_graph]
+    for test in tests:
+        test(server, url)
+        print('{0}: OK'.format(test.__name__))
+    # Keep-alive connections are reused across all the requests.
+    print('requests: {0}, connections: {1}'.format(
+        sum(server.request_nums.values()), server.connection_num))
+    assert server.connection_num <= virtuoso_wrapper.CONCURRENCY
+    server.shutdown()